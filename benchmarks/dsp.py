@@ -0,0 +1,62 @@
+""" Benchmark the capture to playback format conversion.
+
+Streams a synthetic 1 kHz tone through FormatConverter in buffers of the live callback's size and reports the CPU
+share of one core and the signal to noise ratio of the converted tone for common device format combinations.
+
+    python -m benchmarks.dsp --seconds 30
+"""
+import argparse
+import time
+
+import numpy as np
+
+from mute_button.dsp import FormatConverter
+
+
+FORMATS = [
+    (48000, 2, 48000, 2),
+    (48000, 2, 44100, 2),
+    (44100, 2, 48000, 2),
+    (48000, 2, 48000, 1),
+    (48000, 1, 44100, 2),
+    (48000, 8, 48000, 2),
+]
+
+
+def tone_snr(samples: np.ndarray, rate: int, frequency: float) -> float:
+    t = np.arange(len(samples)) / rate
+    basis = np.stack([np.sin(2 * np.pi * frequency * t), np.cos(2 * np.pi * frequency * t)], axis=1)
+    coefficients = np.linalg.lstsq(basis, samples, rcond=None)[0]
+    fitted = basis @ coefficients
+    return 20 * np.log10(np.std(fitted) / max(np.std(samples - fitted), 1e-9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=30.0, help='Duration of audio to convert per format')
+    parser.add_argument('--buffer-ms', type=float, default=50.0, help='Buffer duration (default: 50 ms like the live callback)')
+    args = parser.parse_args()
+
+    for in_rate, in_channels, out_rate, out_channels in FORMATS:
+        frames_per_buffer = int(in_rate * args.buffer_ms / 1000)
+        converter = FormatConverter(in_rate, in_channels, out_rate, out_channels, frames_per_buffer)
+        tone = (np.sin(2 * np.pi * 1000 * np.arange(frames_per_buffer * 200) / in_rate) * 16000).astype(np.int16)
+        data = np.repeat(tone[:, None], in_channels, axis=1).tobytes()
+        buffer_bytes = frames_per_buffer * in_channels * 2
+        buffers = int(args.seconds * in_rate / frames_per_buffer)
+        output = []
+        cpu = 0.0
+        for i in range(buffers):
+            offset = (i % 200) * buffer_bytes
+            start = time.process_time()
+            converted = converter.process(data[offset:offset + buffer_bytes])
+            cpu += time.process_time() - start
+            if i < 100:
+                output.append(bytes(converted))
+        converted = np.frombuffer(b''.join(output), dtype=np.int16).reshape(-1, out_channels)[:, 0].astype(np.float64)
+        print('{:>6} Hz {} ch -> {:>6} Hz {} ch: {:6.3f}% of one core, SNR {:5.1f} dB'.format(
+            in_rate, in_channels, out_rate, out_channels, 100 * cpu / args.seconds, tone_snr(converted[out_rate // 10:], out_rate, 1000)))
+
+
+if __name__ == '__main__':
+    main()
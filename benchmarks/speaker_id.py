@@ -0,0 +1,70 @@
+""" Benchmark the streaming speaker detector against WAV fixtures.
+
+Builds the speaker model from a speakers directory (same layout as SPEAKERS_DIR), streams a 16 bit WAV file through
+SpeakerDetector in buffers of the live callback's size and reports the CPU time per buffer and the delay between
+each given onset of target speech and the moment muting starts.
+
+    python -m benchmarks.speaker_id --speakers fixtures/speakers --input fixtures/meeting.wav --target alice --onset 5.0
+"""
+import argparse
+import time
+import wave
+
+import numpy as np
+
+from mute_button.speaker_id import DEFAULT_THRESHOLD, SpeakerDetector, SpeakerModel
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--speakers', required=True, help='Directory with one subdirectory of WAV samples per speaker')
+    parser.add_argument('--input', required=True, help='WAV file to stream through the detector')
+    parser.add_argument('--target', action='append', default=[], help='Speaker to mute, can be repeated')
+    parser.add_argument('--onset', action='append', type=float, default=[], help='Start of target speech in seconds, can be repeated')
+    parser.add_argument('--buffer-ms', type=float, default=50.0, help='Buffer duration (default: 50 ms like the live callback)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model = SpeakerModel.from_directory(args.speakers)
+    print('Model: {} speaker(s) built in {:.1f} ms'.format(len(model.labels), (time.perf_counter() - start) * 1000))
+
+    with wave.open(args.input, 'rb') as wf:
+        channels = wf.getnchannels()
+        rate = wf.getframerate()
+        data = wf.readframes(wf.getnframes())
+    frames_per_buffer = int(rate * args.buffer_ms / 1000)
+    buffer_bytes = frames_per_buffer * channels * 2
+    detector = SpeakerDetector(model, rate, channels, args.target, threshold=args.threshold)
+
+    cpu_times = []
+    muted = []
+    # Times at which muting starts (True) or ends (False), at the frames the detector applies them at
+    changes = []
+    for offset in range(0, len(data) - buffer_bytes + 1, buffer_bytes):
+        start = time.process_time()
+        muted.append(detector.push(data[offset:offset + buffer_bytes]))
+        cpu_times.append(time.process_time() - start)
+        buffer_start = offset // (channels * 2)
+        changes += [((buffer_start + frame) / rate, change) for frame, change in detector.changes]
+    cpu_ms = np.array(cpu_times) * 1000
+    muted = np.array(muted)
+    buffer_ends = (np.arange(len(muted)) + 1) * frames_per_buffer / rate
+
+    print('Buffers: {} of {:.1f} ms'.format(len(cpu_ms), args.buffer_ms))
+    print('CPU per buffer: mean {:.3f} ms, p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms ({:.2f}% of real time)'.format(
+        cpu_ms.mean(), np.percentile(cpu_ms, 50), np.percentile(cpu_ms, 99), cpu_ms.max(), 100 * cpu_ms.mean() / args.buffer_ms))
+    print('Muted: {:.1f}% of {:.1f} s'.format(100 * muted.mean(), buffer_ends[-1] if len(buffer_ends) else 0))
+    for onset in args.onset:
+        before = [change for change_time, change in changes if change_time <= onset]
+        mute_starts = [change_time for change_time, change in changes if change and change_time > onset]
+        if before and before[-1]:
+            print('Onset {:.2f} s: already muted'.format(onset))
+        elif len(mute_starts) == 0:
+            print('Onset {:.2f} s: not detected'.format(onset))
+        else:
+            print('Onset {:.2f} s: muted after {:.0f} ms'.format(onset, (mute_starts[0] - onset) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,446 @@
+import collections
+import logging as log
+import os
+import threading
+import time
+import wave
+
+try:
+    import pyaudiowpatch as pyaudio
+except ImportError:  # Only available on Windows
+    pyaudio = None
+
+
+# Device info dicts returned by all backends use the same keys as PortAudio's device info
+LOOPBACK_SUFFIX = ' [Loopback]'
+
+# Stream callback status flags, same values as PortAudio's
+INPUT_UNDERFLOW = 0x1
+INPUT_OVERFLOW = 0x2
+OUTPUT_UNDERFLOW = 0x4
+OUTPUT_OVERFLOW = 0x8
+
+
+class AudioBackend:
+    """ Interface for device discovery and stream handling. All streams use 16 bit signed integer samples.
+    """
+    CONTINUE = 0  # Same value as pyaudio.paContinue
+    COMPLETE = 1  # Same value as pyaudio.paComplete
+
+    def get_devices(self) -> list[dict]:
+        raise NotImplementedError
+
+    def get_sample_size(self) -> int:
+        raise NotImplementedError
+
+    def watch_devices(self, callback) -> bool:
+        """ Call callback from any thread when devices are added, removed or change state. Returns whether device
+        changes are reported at all.
+        """
+        return False
+
+    def open_input(self, device_info: dict, channels: int, rate: int, frames_per_buffer: int, stream_callback, ready=None):
+        """ Open a capture stream. ready optionally tells whether stream_callback can take another buffer; backends
+        without a device clock use it for pacing, the others ignore it.
+        """
+        raise NotImplementedError
+
+    def open_output(self, device_info: dict, channels: int, rate: int, frames_per_buffer: int, stream_callback=None, ready=None):
+        """ Open a playback stream, pulling audio from stream_callback if given and written to otherwise. ready
+        optionally tells whether stream_callback has another buffer to play, see open_input().
+        """
+        raise NotImplementedError
+
+    def terminate(self):
+        pass
+
+
+class WasapiBackend(AudioBackend):
+    CONTINUE = pyaudio.paContinue if pyaudio else AudioBackend.CONTINUE
+    COMPLETE = pyaudio.paComplete if pyaudio else AudioBackend.COMPLETE
+
+    def __init__(self):
+        if pyaudio is None:
+            raise RuntimeError('The WASAPI audio backend requires pyaudiowpatch (Windows only).')
+        self._pa = None
+        self._lock = threading.Lock()
+        self._open_streams = 0
+        self._outdated = False
+        self._on_devices_changed = None
+        self._notification_client = None
+
+    def get_devices(self) -> list[dict]:
+        # PortAudio only sees the devices present when it was initialized and its device indices are only valid for
+        # that initialization, so devices are enumerated by the instance that opens the streams. It is re-initialized
+        # to find new devices while no streams are open, otherwise devices are enumerated again after the last closes.
+        with self._lock:
+            if self._open_streams == 0:
+                if self._pa is not None:
+                    self._pa.terminate()
+                self._pa = pyaudio.PyAudio()
+                self._outdated = False
+            else:
+                self._outdated = True
+            return list(self._pa.get_device_info_generator_by_host_api(host_api_type=pyaudio.paWASAPI))
+
+    def get_sample_size(self) -> int:
+        return pyaudio.get_sample_size(pyaudio.paInt16)
+
+    def watch_devices(self, callback) -> bool:
+        self._on_devices_changed = callback
+        # Endpoint notifications need pycaw, which is optional
+        try:
+            from pycaw.callbacks import MMNotificationClient
+            from pycaw.utils import AudioUtilities
+        except ImportError:
+            return False
+
+        class DeviceNotificationClient(MMNotificationClient):
+            def on_device_added(self, *args):
+                callback()
+
+            def on_device_removed(self, *args):
+                callback()
+
+            def on_device_state_changed(self, *args):
+                callback()
+
+            def on_default_device_changed(self, *args):
+                callback()
+
+        try:
+            client = DeviceNotificationClient()
+            AudioUtilities.GetDeviceEnumerator().RegisterEndpointNotificationCallback(client)
+        except OSError as e:
+            log.warning('Could not register for audio device notifications: {}'.format(e))
+            return False
+        # Referenced for as long as the backend lives since the enumerator calls it
+        self._notification_client = client
+        return True
+
+    def _open(self, **kwargs):
+        with self._lock:
+            if self._pa is None:
+                self._pa = pyaudio.PyAudio()
+            stream = self._pa.open(format=pyaudio.paInt16, **kwargs)
+            self._open_streams += 1
+        close = stream.close
+
+        def tracked_close():
+            # Counted once, later calls go straight to PortAudio
+            stream.close = close
+            try:
+                close()
+            finally:
+                self._stream_closed()
+        stream.close = tracked_close
+        return stream
+
+    def _stream_closed(self):
+        with self._lock:
+            self._open_streams -= 1
+            reenumerate = self._open_streams == 0 and self._outdated
+        if reenumerate and self._on_devices_changed is not None:
+            self._on_devices_changed()
+
+    def open_input(self, device_info: dict, channels: int, rate: int, frames_per_buffer: int, stream_callback, ready=None):
+        return self._open(channels=channels, rate=rate, frames_per_buffer=frames_per_buffer, input=True,
+                          input_device_index=device_info['index'], stream_callback=stream_callback)
+
+    def open_output(self, device_info: dict, channels: int, rate: int, frames_per_buffer: int, stream_callback=None, ready=None):
+        return self._open(channels=channels, rate=rate, frames_per_buffer=frames_per_buffer, output=True,
+                          output_device_index=device_info['index'], stream_callback=stream_callback)
+
+    def terminate(self):
+        with self._lock:
+            if self._pa is not None:
+                self._pa.terminate()
+                self._pa = None
+            self._open_streams = 0
+
+
+class VirtualPacer:
+    """ Lets the virtual streams of a backend running as fast as possible wait for their callbacks to be ready.
+
+    Every stream notifies the pacer after each buffer it moved, so a stream waiting for the other side of its
+    callbacks blocks instead of spinning.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+
+    def notify(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait(self, ready, running: threading.Event) -> bool:
+        """ Block until ready() is true and return False if running was cleared in the meantime.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not running.is_set() or ready())
+            return running.is_set()
+
+
+class VirtualInputStream:
+    """ Plays a WAV file into a stream callback from a background thread, like a PortAudio callback stream would.
+
+    With speed=1.0 buffers are delivered in real time, larger values run faster than real time and speed=0 delivers
+    buffers as fast as the callback returns, or as fast as it is ready for them if ready and pacer are given.
+    """
+    def __init__(self, source_path: str, channels: int, rate: int, frames_per_buffer: int, stream_callback,
+                 speed: float = 1.0, loop: bool = True, ready=None, pacer: VirtualPacer | None = None):
+        self._wf = wave.open(source_path, 'rb')
+        if self._wf.getnchannels() != channels or self._wf.getframerate() != rate or self._wf.getsampwidth() != 2:
+            self._wf.close()
+            raise ValueError('Virtual source {} does not match requested format ({} channels, {} Hz, 16 bit).'.format(source_path, channels, rate))
+        self._channels = channels
+        self._rate = rate
+        self._frames_per_buffer = frames_per_buffer
+        self._callback = stream_callback
+        self._speed = speed
+        self._loop = loop
+        self._ready = ready if speed <= 0 and pacer is not None else None
+        self._pacer = pacer
+        self._running = threading.Event()
+        self._thread = None
+        self.start_stream()
+
+    def _read_buffer(self) -> bytes | None:
+        data = self._wf.readframes(self._frames_per_buffer)
+        missing = self._frames_per_buffer * self._channels * 2 - len(data)
+        if missing > 0 and self._loop and self._wf.getnframes() > 0:
+            self._wf.rewind()
+            while missing > 0:
+                chunk = self._wf.readframes(missing // (self._channels * 2))
+                if not chunk:
+                    self._wf.rewind()
+                    continue
+                data += chunk
+                missing -= len(chunk)
+        elif missing > 0:
+            if len(data) == 0:
+                return None
+            data += bytes(missing)
+        return data
+
+    def _run(self):
+        buffer_time = self._frames_per_buffer / self._rate
+        start_time = time.perf_counter()
+        buffers = 0
+        while self._running.is_set():
+            if self._ready is not None and not self._pacer.wait(self._ready, self._running):
+                break
+            data = self._read_buffer()
+            if data is None:
+                break
+            now = time.perf_counter() - start_time
+            time_info = {'input_buffer_adc_time': now - buffer_time, 'current_time': now, 'output_buffer_dac_time': 0.0}
+            _, flag = self._callback(data, self._frames_per_buffer, time_info, 0)
+            if self._pacer is not None:
+                self._pacer.notify()
+            if flag != AudioBackend.CONTINUE:
+                break
+            buffers += 1
+            if self._speed > 0:
+                delay = buffers * buffer_time / self._speed - (time.perf_counter() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+        self._running.clear()
+
+    def start_stream(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name='virtual-input', daemon=True)
+            self._thread.start()
+
+    def stop_stream(self):
+        self._running.clear()
+        if self._pacer is not None:
+            self._pacer.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_active(self) -> bool:
+        return self._running.is_set()
+
+    def close(self):
+        self.stop_stream()
+        self._wf.close()
+
+
+class VirtualOutputStream:
+    """ Output stream writing to a VirtualSink, paced like a playback device at the given speed.
+
+    Without a stream callback writes block like a PortAudio blocking stream, with one a background thread pulls a
+    buffer from the callback whenever the simulated device needs one. With speed=0, ready and pacer, it pulls a buffer
+    whenever the callback is ready to provide one instead.
+    """
+    def __init__(self, sink: 'VirtualSink', channels: int, rate: int, frames_per_buffer: int, speed: float = 1.0, stream_callback=None,
+                 ready=None, pacer: VirtualPacer | None = None):
+        self._sink = sink
+        self._frame_size = channels * 2
+        self._rate = rate
+        self._frames_per_buffer = frames_per_buffer
+        self._speed = speed
+        self._start_time = None
+        self._frames_written = 0
+        self._callback = stream_callback
+        self._ready = ready if speed <= 0 and pacer is not None else None
+        self._pacer = pacer
+        self._running = threading.Event()
+        self._thread = None
+        sink.open(channels, rate)
+        if stream_callback is not None:
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name='virtual-output', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        buffer_time = self._frames_per_buffer / self._rate
+        start_time = time.perf_counter()
+        buffers = 0
+        while self._running.is_set():
+            if self._ready is not None and not self._pacer.wait(self._ready, self._running):
+                break
+            now = time.perf_counter() - start_time
+            time_info = {'input_buffer_adc_time': 0.0, 'current_time': now, 'output_buffer_dac_time': now + buffer_time}
+            data, flag = self._callback(None, self._frames_per_buffer, time_info, 0)
+            if self._pacer is not None:
+                self._pacer.notify()
+            self._sink.write(data)
+            if flag != AudioBackend.CONTINUE:
+                break
+            buffers += 1
+            if self._speed > 0:
+                delay = buffers * buffer_time / self._speed - (time.perf_counter() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+        self._running.clear()
+
+    def write(self, frames: bytes, num_frames: int = None, exception_on_underflow: bool = False):
+        if self._start_time is None:
+            self._start_time = time.perf_counter()
+        self._sink.write(frames)
+        self._frames_written += len(frames) // self._frame_size
+        if self._speed > 0:
+            # Block while more than one buffer is queued ahead of the simulated playback position
+            ahead = (self._frames_written - self._frames_per_buffer) / self._rate / self._speed - (time.perf_counter() - self._start_time)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def stop_stream(self):
+        self._running.clear()
+        if self._pacer is not None:
+            self._pacer.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_active(self) -> bool:
+        return self._callback is None or self._running.is_set()
+
+    def close(self):
+        self.stop_stream()
+        self._sink.close()
+
+
+class VirtualSink:
+    """ Collects played audio either in memory (path=None) or in a WAV file.
+
+    In memory only the last tail_seconds of audio are kept so that long throughput runs use bounded memory;
+    frames_written counts all frames.
+    """
+    def __init__(self, path: str | None = None, tail_seconds: float = 60.0):
+        self.path = path
+        self.tail_seconds = tail_seconds
+        self.frames_written = 0
+        self._frame_size = 2
+        self._tail = collections.deque()
+        self._tail_bytes = 0
+        self._max_tail_bytes = 0
+        self._wf = None
+        self._lock = threading.Lock()
+
+    @property
+    def data(self) -> bytes:
+        """ The last tail_seconds of audio written in memory.
+        """
+        with self._lock:
+            return b''.join(self._tail)
+
+    def open(self, channels: int, rate: int):
+        with self._lock:
+            self._frame_size = channels * 2
+            self._max_tail_bytes = int(self.tail_seconds * rate) * self._frame_size
+            if self.path is not None and self._wf is None:
+                self._wf = wave.open(self.path, 'wb')
+                self._wf.setnchannels(channels)
+                self._wf.setsampwidth(2)
+                self._wf.setframerate(rate)
+
+    def write(self, frames: bytes):
+        with self._lock:
+            if self._wf is not None:
+                self._wf.writeframesraw(frames)
+            else:
+                self._tail.append(bytes(frames))
+                self._tail_bytes += len(frames)
+                while self._tail_bytes - len(self._tail[0]) >= self._max_tail_bytes and len(self._tail) > 1:
+                    self._tail_bytes -= len(self._tail.popleft())
+            self.frames_written += len(frames) // self._frame_size
+
+    def close(self):
+        with self._lock:
+            if self._wf is not None:
+                self._wf.close()
+                self._wf = None
+
+
+class VirtualBackend(AudioBackend):
+    """ Backend without audio hardware: a WAV file acts as the loopback device and a VirtualSink as the playback device.
+    """
+    def __init__(self, source_path: str, sink: VirtualSink | None = None, speed: float = 1.0, loop: bool = True):
+        with wave.open(source_path, 'rb') as wf:
+            channels = wf.getnchannels()
+            rate = wf.getframerate()
+        self.source_path = source_path
+        self.sink = sink or VirtualSink()
+        self.speed = speed
+        self.loop = loop
+        self._pacer = VirtualPacer()
+        self._devices = [
+            {'index': 0, 'name': 'Virtual source' + LOOPBACK_SUFFIX, 'maxInputChannels': channels, 'maxOutputChannels': 0,
+             'defaultSampleRate': float(rate), 'isLoopbackDevice': True},
+            {'index': 1, 'name': 'Virtual sink', 'maxInputChannels': 0, 'maxOutputChannels': channels,
+             'defaultSampleRate': float(rate), 'isLoopbackDevice': False},
+        ]
+
+    def get_devices(self) -> list[dict]:
+        return [dict(dev) for dev in self._devices]
+
+    def get_sample_size(self) -> int:
+        return 2
+
+    def open_input(self, device_info: dict, channels: int, rate: int, frames_per_buffer: int, stream_callback, ready=None):
+        return VirtualInputStream(self.source_path, channels, rate, frames_per_buffer, stream_callback, self.speed, self.loop,
+                                  ready, self._pacer)
+
+    def open_output(self, device_info: dict, channels: int, rate: int, frames_per_buffer: int, stream_callback=None, ready=None):
+        return VirtualOutputStream(self.sink, channels, rate, frames_per_buffer, self.speed, stream_callback, ready, self._pacer)
+
+
+def create_audio_backend() -> AudioBackend:
+    """ Create the backend selected by the MUTE_BUTTON_AUDIO_BACKEND environment variable ('wasapi' or 'virtual').
+
+    The virtual backend is configured with MUTE_BUTTON_VIRTUAL_SOURCE (WAV file, required), MUTE_BUTTON_VIRTUAL_SINK
+    (WAV file, in-memory if unset) and MUTE_BUTTON_VIRTUAL_SPEED (1.0 is real time, 0 is as fast as possible).
+    """
+    name = os.environ.get('MUTE_BUTTON_AUDIO_BACKEND', 'wasapi').lower()
+    if name == 'wasapi':
+        return WasapiBackend()
+    elif name == 'virtual':
+        source_path = os.environ.get('MUTE_BUTTON_VIRTUAL_SOURCE')
+        if not source_path:
+            raise RuntimeError('MUTE_BUTTON_VIRTUAL_SOURCE must point to a WAV file when using the virtual audio backend.')
+        sink_path = os.environ.get('MUTE_BUTTON_VIRTUAL_SINK')
+        speed = float(os.environ.get('MUTE_BUTTON_VIRTUAL_SPEED', '1.0'))
+        return VirtualBackend(source_path, VirtualSink(sink_path), speed)
+    raise ValueError('Unknown audio backend ' + name)
@@ -0,0 +1,242 @@
+import logging as log
+import threading
+import time
+
+from mute_button.audio_backend import INPUT_OVERFLOW, OUTPUT_UNDERFLOW, AudioBackend
+from mute_button.dsp import FADE_SECONDS, FormatConverter, GainRamp
+from mute_button.jitter_buffer import JitterBuffer
+from mute_button.level_meter import LevelMeter
+from mute_button.metrics import STREAM_BUCKETS, Histogram, PrometheusWriter, RouteMetrics, SessionMetrics
+from mute_button.ring_buffer import RingBuffer
+from mute_button.speaker_id import SpeakerDetector, SpeakerModel
+
+
+# Recording buffers are preallocated per session while it is subscribed to a route and only need to bridge the
+# interval in which the recording writer drains them to disk
+RECORDING_BUFFER_SECONDS = 5
+
+
+def gate_buffer(speaker_detector: SpeakerDetector, in_data, forward: bool, mute: bool) -> tuple[float, list]:
+    """ Gain target at the start of a captured buffer and the (frame offset, target) changes within it.
+    """
+    # Silence is forwarded as well so that playback keeps running while muted
+    target = 1.0 if forward and not mute else 0.0
+    changes = ()
+    if speaker_detector.targets:
+        was_muted = speaker_detector.muted
+        speaker_detector.push(in_data)
+        if target > 0:
+            target = 0.0 if was_muted else 1.0
+            changes = [(offset, 0.0 if muted else 1.0) for offset, muted in speaker_detector.changes]
+    return target, changes
+
+
+class SessionControl:
+    """ Flags of one session, written by its event handlers and read by the audio callbacks without a lock.
+
+    Attributes are only ever replaced as a whole, so a callback sees either the old or the new value. The session's
+    metrics are in turn only written by the callbacks.
+    """
+    __slots__ = ('forward', 'mute', 'record', 'mute_speakers', 'recording_buffer', 'route', 'metrics')
+
+    def __init__(self):
+        self.forward = False
+        self.mute = False
+        self.record = False
+        self.mute_speakers = frozenset()
+        self.recording_buffer = None
+        self.route = None
+        self.metrics = SessionMetrics()
+
+
+class AudioRoute:
+    """ Capture and playback streams between one pair of devices, shared by all sessions subscribed to it.
+
+    The playback device is shared too, so audio is forwarded while any session forwards and no session mutes, and
+    the speakers muted by any session are muted. Recording is per session. The callbacks read the tuple of
+    subscribed controls, which is replaced rather than modified when sessions come and go.
+    """
+    def __init__(self, backend: AudioBackend, key: tuple, loopback_device_info: dict, playback_device_info: dict,
+                 buffer_seconds: float, playback_buffer_ms: int, model: SpeakerModel, xruns: dict, metrics: RouteMetrics):
+        self.backend = backend
+        self.key = key
+        self.name = metrics.name
+        self.buffer_seconds = buffer_seconds
+        self.xruns = xruns
+        self.metrics = metrics
+        self.controls = ()
+        self.input_rate = int(loopback_device_info['defaultSampleRate'])
+        self.output_rate = int(playback_device_info['defaultSampleRate'])
+        self.input_channels = loopback_device_info['maxInputChannels']
+        output_rate = self.output_rate
+        output_channels = playback_device_info['maxOutputChannels']
+        frames_per_buffer = int(self.input_rate * buffer_seconds)
+        output_frames_per_buffer = int(output_rate * buffer_seconds)
+        self.jitter_buffer = JitterBuffer(output_rate, output_channels, target_frames=int(output_rate * playback_buffer_ms / 1000),
+                                          burst_frames=max(output_frames_per_buffer, frames_per_buffer * output_rate // self.input_rate + 1))
+        self.converter = FormatConverter(self.input_rate, self.input_channels, output_rate, output_channels, frames_per_buffer)
+        self.gain = GainRamp(int(self.input_rate * FADE_SECONDS), frames_per_buffer)
+        self.speaker_detector = SpeakerDetector(model, self.input_rate, self.input_channels)
+        self.input_meter = LevelMeter(self.input_rate, self.input_channels, frames_per_buffer)
+        self.output_meter = LevelMeter(output_rate, output_channels, output_frames_per_buffer)
+        self.output_stream = backend.open_output(playback_device_info, channels=output_channels, rate=output_rate,
+                                                 frames_per_buffer=output_frames_per_buffer, stream_callback=self._output_callback,
+                                                 ready=lambda: self.jitter_buffer.can_read(output_frames_per_buffer))
+        try:
+            self.input_stream = backend.open_input(loopback_device_info, channels=self.input_channels, rate=self.input_rate,
+                                                   frames_per_buffer=frames_per_buffer, stream_callback=self._input_callback,
+                                                   ready=lambda: self.jitter_buffer.can_write(output_frames_per_buffer))
+        except Exception:
+            # The playback stream is already running its callback
+            self.output_stream.stop_stream()
+            self.output_stream.close()
+            raise
+
+    def add(self, control: SessionControl):
+        control.recording_buffer = RingBuffer(int(self.input_rate * RECORDING_BUFFER_SECONDS), self.input_channels)
+        control.route = self
+        self.controls = self.controls + (control,)
+        self.refresh_targets()
+
+    def remove(self, control: SessionControl):
+        self.controls = tuple(c for c in self.controls if c is not control)
+        control.route = None
+        control.record = False
+        self.refresh_targets()
+
+    def refresh_targets(self):
+        self.speaker_detector.targets = set().union(*(control.mute_speakers for control in self.controls))
+
+    def _input_callback(self, in_data, frame_count, time_info, status):
+        start = time.perf_counter()
+        metrics = self.metrics
+        self.xruns['callbacks'] += 1
+        if status:
+            metrics.count_status(status)
+            if status & INPUT_OVERFLOW:
+                self.xruns['input_overflows'] += 1
+        controls = self.controls
+        forward = any(control.forward for control in controls)
+        mute = any(control.mute for control in controls)
+        target, changes = gate_buffer(self.speaker_detector, in_data, forward, mute)
+        data = self.converter.process(in_data, self.gain, target, changes)
+        self.input_meter.push(in_data)
+        self.output_meter.push(data)
+        self.jitter_buffer.write(data, time_info['current_time'] - time_info['input_buffer_adc_time'])
+        # Silence written while no session forwards keeps playback running but is not counted as forwarded
+        if forward:
+            metrics.forwarded_bytes += len(data)
+        for control in controls:
+            if control.record:
+                recording_buffer = control.recording_buffer
+                recording_buffer.write(in_data)
+                control.metrics.recorded_bytes += len(in_data)
+                control.metrics.recording_buffer_seconds.observe(recording_buffer.available() / self.input_rate)
+        metrics.input_callback_seconds.observe(time.perf_counter() - start)
+        return in_data, self.backend.CONTINUE
+
+    def _output_callback(self, in_data, frame_count, time_info, status):
+        start = time.perf_counter()
+        metrics = self.metrics
+        if status:
+            metrics.count_status(status)
+            if status & OUTPUT_UNDERFLOW:
+                self.xruns['output_underflows'] += 1
+        jitter_buffer = self.jitter_buffer
+        metrics.playback_buffer_seconds.observe(jitter_buffer.ring.available() / self.output_rate)
+        underruns = jitter_buffer.underruns
+        data = jitter_buffer.read(frame_count, time_info['output_buffer_dac_time'] - time_info['current_time'])
+        if jitter_buffer.underruns != underruns:
+            self.xruns['playback_underruns'] += 1
+            metrics.playback_underruns += 1
+        metrics.output_callback_seconds.observe(time.perf_counter() - start)
+        return data, self.backend.CONTINUE
+
+    def close(self):
+        self.input_stream.stop_stream()
+        self.input_stream.close()
+        self.output_stream.stop_stream()
+        self.output_stream.close()
+
+
+class AudioEngine:
+    """ Process-wide owner of the audio routes.
+
+    A route is opened by the first session subscribing to its devices and buffer settings and closed when the last
+    one unsubscribes, so the audio work does not grow with the number of open clients.
+    """
+    def __init__(self, backend: AudioBackend):
+        self.backend = backend
+        self.routes: dict[tuple, AudioRoute] = {}
+        self.route_metrics: dict[tuple, RouteMetrics] = {}
+        self.stream_open_seconds = Histogram(STREAM_BUCKETS)
+        self.stream_close_seconds = Histogram(STREAM_BUCKETS)
+        self._lock = threading.Lock()
+
+    def subscribe(self, control: SessionControl, loopback_device_info: dict, playback_device_info: dict,
+                  buffer_seconds: float, playback_buffer_ms: int, model: SpeakerModel, xruns: dict) -> AudioRoute:
+        key = (loopback_device_info['index'], playback_device_info['index'], buffer_seconds, playback_buffer_ms)
+        with self._lock:
+            route = self.routes.get(key)
+            if route is None:
+                metrics = self.route_metrics.get(key)
+                if metrics is None:
+                    metrics = RouteMetrics('{} to {}'.format(loopback_device_info['name'], playback_device_info['name']), {
+                        'capture': loopback_device_info['name'], 'playback': playback_device_info['name'],
+                        'buffer_seconds': str(buffer_seconds), 'playback_buffer_ms': str(playback_buffer_ms),
+                    })
+                    self.route_metrics[key] = metrics
+                start = time.perf_counter()
+                route = AudioRoute(self.backend, key, loopback_device_info, playback_device_info, buffer_seconds,
+                                   playback_buffer_ms, model, xruns, metrics)
+                self.stream_open_seconds.observe(time.perf_counter() - start)
+                self.routes[key] = route
+                log.info('Opened audio route from {}.'.format(route.name))
+            route.add(control)
+            return route
+
+    def unsubscribe(self, control: SessionControl):
+        with self._lock:
+            route = control.route
+            if route is None:
+                return
+            route.remove(control)
+            if len(route.controls) == 0:
+                start = time.perf_counter()
+                route.close()
+                self.stream_close_seconds.observe(time.perf_counter() - start)
+                del self.routes[route.key]
+                log.info('Closed audio route from {}.'.format(route.name))
+
+    def set_speaker_model(self, model: SpeakerModel):
+        with self._lock:
+            for route in self.routes.values():
+                route.speaker_detector.model = model
+
+    def write_metrics(self, writer: PrometheusWriter):
+        with self._lock:
+            routes = {key: len(route.controls) for key, route in self.routes.items()}
+            route_metrics = list(self.route_metrics.items())
+        writer.histogram('mute_button_stream_open_seconds', 'Time to open the streams of an audio route.', self.stream_open_seconds)
+        writer.histogram('mute_button_stream_close_seconds', 'Time to close the streams of an audio route.', self.stream_close_seconds)
+        # Samples of a metric must be contiguous, so each metric is written for all routes before the next one
+        for key, metrics in route_metrics:
+            writer.sample('mute_button_route_sessions', 'gauge', 'Sessions subscribed to an audio route.', routes.get(key, 0), metrics.labels)
+        for key, metrics in route_metrics:
+            writer.histogram('mute_button_callback_seconds', 'Duration of the audio stream callbacks.',
+                             metrics.input_callback_seconds, {**metrics.labels, 'stream': 'input'})
+            writer.histogram('mute_button_callback_seconds', 'Duration of the audio stream callbacks.',
+                             metrics.output_callback_seconds, {**metrics.labels, 'stream': 'output'})
+        for key, metrics in route_metrics:
+            writer.histogram('mute_button_playback_buffer_seconds', 'Audio buffered for playback at each playback callback.',
+                             metrics.playback_buffer_seconds, metrics.labels)
+        for key, metrics in route_metrics:
+            for flag, count in metrics.status_flags.items():
+                writer.sample('mute_button_stream_status_total', 'counter', 'Callbacks reporting an xrun status flag.',
+                              count, {**metrics.labels, 'flag': flag})
+        for key, metrics in route_metrics:
+            writer.sample('mute_button_playback_underruns_total', 'counter', 'Playback callbacks padded with silence.',
+                          metrics.playback_underruns, metrics.labels)
+        for key, metrics in route_metrics:
+            writer.sample('mute_button_forwarded_bytes_total', 'counter', 'Bytes of audio forwarded to the playback device, muted audio included.',
+                          metrics.forwarded_bytes, metrics.labels)
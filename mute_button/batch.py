@@ -0,0 +1,256 @@
+""" Apply the mute pipeline to recorded audio files.
+
+Streams each file through the same gating as the live capture callback, with forwarding on and the given speakers
+muted, and writes the muted audio to the output directory along with a JSON report of the muted intervals. Files are
+split into segments that are processed in parallel; each segment starts with a warm-up so that the speaker detector
+and the gain ramp are in the state they would have reached when streaming the file in one piece.
+
+    mute-button-batch --mute alice --output-dir muted meetings/
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+from mute_button.audio_engine import gate_buffer
+from mute_button.dsp import FADE_SECONDS, FormatConverter, GainRamp
+from mute_button.speaker_id import DEFAULT_THRESHOLD, SAMPLE_EXTENSIONS, SpeakerDetector, SpeakerModel
+from mute_button.speaker_index import SpeakerIndex
+
+
+DEFAULT_SPEAKERS_DIR = os.path.join(os.environ.get('REFLEX_UPLOADED_FILES_DIR', 'uploaded_files'), 'audio', 'speakers')
+BUFFER_MS = 50
+SEGMENT_SECONDS = 600
+WARMUP_SECONDS = 2.0
+WRITE_SECONDS = 10
+
+_model: SpeakerModel | None = None
+
+
+def _init_worker(model: SpeakerModel):
+    global _model
+    _model = model
+
+
+def _audio_format(path: str) -> str:
+    return 'FLAC' if path.lower().endswith('.flac') else 'WAV'
+
+
+def process_segment(input_path: str, output_path: str, start: int, end: int, warmup: int, frames_per_buffer: int,
+                    targets: list[str], threshold: float) -> tuple[list[tuple[int, int]], float]:
+    """ Mute frames [start, end) of input_path into output_path, streaming from warmup frames earlier, and return the
+    muted frame ranges and the CPU time taken.
+    """
+    cpu_start = time.process_time()
+    info = sf.info(input_path)
+    rate, channels = info.samplerate, info.channels
+    detector = SpeakerDetector(_model, rate, channels, targets, threshold=threshold)
+    converter = FormatConverter(rate, channels, rate, channels, frames_per_buffer)
+    gain = GainRamp(int(rate * FADE_SECONDS), frames_per_buffer)
+    intervals = []
+    muted_from = None
+    pending = []
+    pending_frames = 0
+    position = start - warmup
+    with sf.SoundFile(output_path, 'w', rate, channels, subtype='PCM_16', format=_audio_format(output_path)) as output:
+        for block in sf.blocks(input_path, blocksize=frames_per_buffer, start=position, stop=end, dtype='int16', always_2d=True):
+            target, changes = gate_buffer(detector, block, True, False)
+            for offset, value in [(0, target)] + list(changes):
+                frame = position + offset
+                if value == 0.0 and muted_from is None:
+                    muted_from = max(frame, start)
+                elif value > 0.0 and muted_from is not None:
+                    if frame > start:
+                        intervals.append((muted_from, frame))
+                    muted_from = None
+            data = np.frombuffer(converter.process(block, gain, target, changes), dtype=np.int16).reshape(-1, channels)
+            if position + len(data) > start:
+                pending.append(data[max(0, start - position):].copy())
+                pending_frames += len(pending[-1])
+                if pending_frames >= WRITE_SECONDS * rate:
+                    output.write(np.concatenate(pending))
+                    pending, pending_frames = [], 0
+            position += len(block)
+        if pending:
+            output.write(np.concatenate(pending))
+    if muted_from is not None and end > muted_from:
+        intervals.append((muted_from, end))
+    return intervals, time.process_time() - cpu_start
+
+
+def join_parts(parts: list[str], output_path: str):
+    """ Concatenate the segment files into output_path and remove them.
+    """
+    if len(parts) == 1:
+        shutil.move(parts[0], output_path)
+        return
+    info = sf.info(parts[0])
+    with sf.SoundFile(output_path, 'w', info.samplerate, info.channels, subtype='PCM_16', format=_audio_format(output_path)) as output:
+        for part in parts:
+            for block in sf.blocks(part, blocksize=WRITE_SECONDS * info.samplerate, dtype='int16', always_2d=True):
+                output.write(block)
+            os.remove(part)
+
+
+def _merge_intervals(intervals: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def find_inputs(paths: list[str]) -> list[tuple[str, str]]:
+    """ Audio files given directly or found in the given directories, with their path relative to the output directory.
+    """
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(SAMPLE_EXTENSIONS):
+                        full_path = os.path.join(root, name)
+                        inputs.append((full_path, os.path.relpath(full_path, path)))
+        else:
+            inputs.append((path, os.path.basename(path)))
+    return inputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='WAV or FLAC files, or directories to search for them')
+    parser.add_argument('--output-dir', required=True, help='Directory for the muted files, written in the format of the inputs')
+    parser.add_argument('--mute', action='append', required=True, help='Speaker to mute, can be repeated')
+    parser.add_argument('--speakers', default=DEFAULT_SPEAKERS_DIR, help='Directory with one subdirectory of samples per speaker (default: %(default)s)')
+    parser.add_argument('--index-dir', help='Speaker index directory (default: "index" next to the speakers directory)')
+    parser.add_argument('--report', help='JSON report path (default: report.json in the output directory)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes (default: %(default)s)')
+    parser.add_argument('--segment-seconds', type=float, default=SEGMENT_SECONDS, help='Length of the segments processed in parallel (default: %(default)s)')
+    parser.add_argument('--buffer-ms', type=float, default=BUFFER_MS, help='Buffer duration (default: %(default)s ms like the live callback)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    index_dir = args.index_dir or os.path.join(os.path.dirname(os.path.abspath(args.speakers)), 'index')
+    model = SpeakerIndex(args.speakers, index_dir).update()
+    unknown = sorted(set(args.mute) - set(model.labels))
+    if unknown:
+        parser.error('No samples for speaker(s): {}'.format(', '.join(unknown)))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    parts_dir = tempfile.mkdtemp(prefix='.parts-', dir=args.output_dir)
+    report_path = args.report or os.path.join(args.output_dir, 'report.json')
+    files = []
+    output_inputs = {}
+    for path, relative_path in find_inputs(args.inputs):
+        output_path = os.path.join(args.output_dir, relative_path)
+        entry = {'input': path, 'output': output_path}
+        files.append(entry)
+        if os.path.abspath(output_path) == os.path.abspath(path):
+            entry['error'] = 'Output would overwrite the input'
+            continue
+        # Inputs from different directories can map to the same output, only the first one is processed
+        output_key = os.path.normcase(os.path.abspath(output_path))
+        if output_key in output_inputs:
+            entry['error'] = 'Output {} is already written for {}'.format(output_path, output_inputs[output_key])
+            continue
+        output_inputs[output_key] = path
+        try:
+            info = sf.info(path)
+        except (OSError, RuntimeError) as e:
+            entry['error'] = str(e)
+            continue
+        if info.frames == 0:
+            entry['error'] = 'No audio'
+            continue
+        entry.update(rate=info.samplerate, frames=info.frames, parts=[], intervals=[], cpu_seconds=0.0)
+
+    wall_start = time.perf_counter()
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(args.workers, mp_context=context, initializer=_init_worker, initargs=(model,)) as pool:
+        segment_futures = {}
+        for i, entry in enumerate(files):
+            if 'error' in entry:
+                continue
+            rate = entry['rate']
+            frames_per_buffer = max(1, int(rate * args.buffer_ms / 1000))
+            # Segments start on buffer boundaries so that they see the same buffers as a single pass would
+            segment_frames = max(1, int(rate * args.segment_seconds) // frames_per_buffer) * frames_per_buffer
+            warmup_frames = int(np.ceil(rate * WARMUP_SECONDS / frames_per_buffer)) * frames_per_buffer
+            extension = os.path.splitext(entry['output'])[1]
+            for start in range(0, entry['frames'], segment_frames):
+                part = os.path.join(parts_dir, '{}-{}{}'.format(i, len(entry['parts']), extension))
+                entry['parts'].append(part)
+                future = pool.submit(process_segment, entry['input'], part, start, min(start + segment_frames, entry['frames']),
+                                     min(start, warmup_frames), frames_per_buffer, args.mute, args.threshold)
+                segment_futures[future] = entry
+            entry['pending'] = len(entry['parts'])
+        join_futures = {}
+        for future in concurrent.futures.as_completed(segment_futures):
+            entry = segment_futures[future]
+            try:
+                intervals, cpu_seconds = future.result()
+                entry['intervals'] += intervals
+                entry['cpu_seconds'] += cpu_seconds
+            except Exception as e:
+                entry.setdefault('error', str(e))
+            entry['pending'] -= 1
+            if entry['pending'] == 0 and 'error' not in entry:
+                os.makedirs(os.path.dirname(os.path.abspath(entry['output'])), exist_ok=True)
+                join_futures[pool.submit(join_parts, entry['parts'], entry['output'])] = entry
+        for future in concurrent.futures.as_completed(join_futures):
+            try:
+                future.result()
+            except Exception as e:
+                join_futures[future]['error'] = str(e)
+    wall_seconds = time.perf_counter() - wall_start
+    shutil.rmtree(parts_dir, ignore_errors=True)
+
+    report_files = []
+    total_seconds = 0.0
+    for entry in files:
+        if 'error' in entry:
+            print('{}: {}'.format(entry['input'], entry['error']))
+            report_files.append({'input': entry['input'], 'error': entry['error']})
+            continue
+        rate = entry['rate']
+        duration = entry['frames'] / rate
+        intervals = [(round(start / rate, 3), round(end / rate, 3)) for start, end in _merge_intervals(entry['intervals'])]
+        muted_seconds = sum(end - start for start, end in intervals)
+        total_seconds += duration
+        report_files.append({
+            'input': entry['input'],
+            'output': entry['output'],
+            'duration_seconds': round(duration, 3),
+            'muted_seconds': round(muted_seconds, 3),
+            'cpu_seconds': round(entry['cpu_seconds'], 3),
+            'real_time_factor': round(entry['cpu_seconds'] / duration, 5) if duration > 0 else None,
+            'mute_intervals': intervals,
+        })
+        print('{}: {:.1f} s, {:.1f} s muted in {} interval(s)'.format(entry['input'], duration, muted_seconds, len(intervals)))
+    real_time_factor = wall_seconds / total_seconds if total_seconds > 0 else None
+    with open(report_path, 'w') as f:
+        json.dump({
+            'speakers': sorted(args.mute),
+            'workers': args.workers,
+            'duration_seconds': round(total_seconds, 3),
+            'wall_seconds': round(wall_seconds, 3),
+            'real_time_factor': round(real_time_factor, 5) if real_time_factor is not None else None,
+            'files': report_files,
+        }, f, indent=2)
+    if real_time_factor:
+        print('Processed {:.2f} h of audio in {:.1f} s with {} worker(s): real-time factor {:.4f} ({:.0f}x real time)'.format(
+            total_seconds / 3600, wall_seconds, args.workers, real_time_factor, 1 / real_time_factor))
+    print('Report: {}'.format(report_path))
+
+
+if __name__ == '__main__':
+    main()
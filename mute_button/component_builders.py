@@ -1,5 +1,7 @@
 import reflex as rx
 
+from mute_button.level_meter import FLOOR_DB, WAVEFORM_COLUMNS, WAVEFORM_HEIGHT
+
 
 def labeled_component(component: rx.Component, label: str):
     return rx.flex(
@@ -25,3 +27,21 @@ def titled_card(*children: rx.Component, title: str, title_spacing: str = '3'):
         ),
         width = '100%',
     )
+
+def level_meter(label: str, rms_db: rx.Var, peak_db: rx.Var, waveform: rx.Var):
+    return rx.vstack(
+        rx.hstack(
+            rx.text(label, size='1', width='70px'),
+            rx.progress(value=rms_db - int(FLOOR_DB), max=-int(FLOOR_DB), width='200px'),
+            rx.text(rms_db, ' dB RMS, ', peak_db, ' dB peak', size='1', color_scheme='gray'),
+            align='center',
+        ),
+        rx.el.svg(
+            rx.el.svg.path(d=waveform, custom_attrs={'stroke': 'var(--accent-9)', 'strokeWidth': '0.6'}),
+            custom_attrs={'viewBox': '0 0 {} {}'.format(WAVEFORM_COLUMNS, WAVEFORM_HEIGHT), 'preserveAspectRatio': 'none'},
+            width='100%',
+            height='{}px'.format(WAVEFORM_HEIGHT),
+        ),
+        spacing='1',
+        width='100%',
+    )
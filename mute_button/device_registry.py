@@ -0,0 +1,56 @@
+import logging as log
+import threading
+
+from mute_button.audio_backend import AudioBackend
+
+
+class DeviceRegistry:
+    """ Process-wide cache of a backend's audio devices, shared by all sessions.
+
+    Devices are enumerated on first use and again only after invalidate(), which is called on a manual rescan and
+    when the backend reports a device change. version is bumped whenever an enumeration finds different devices.
+    """
+    def __init__(self, backend: AudioBackend):
+        self.backend = backend
+        self.version = 0
+        self._devices: list[dict] = []
+        self._sample_size = None
+        self._stale = True
+        self._watching = False
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self) -> bool:
+        return self._stale
+
+    def invalidate(self):
+        """ Mark the devices for enumeration on next use. Safe to call from any thread.
+        """
+        self._stale = True
+
+    def get_devices(self) -> list[dict]:
+        """ The cached devices, enumerated first if they are stale. Blocks while another thread enumerates.
+        """
+        with self._lock:
+            if not self._watching:
+                self._watching = True
+                if not self.backend.watch_devices(self.invalidate):
+                    log.info('Audio device changes are not reported by this backend, rescan to find new devices.')
+            if self._stale:
+                # Cleared first so that changes reported during the enumeration cause another one
+                self._stale = False
+                devices = self.backend.get_devices()
+                if devices != self._devices:
+                    self._devices = devices
+                    self.version += 1
+                    log.info('Found {} audio device(s).'.format(len(devices)))
+            return self._devices
+
+    def rescan(self) -> list[dict]:
+        self.invalidate()
+        return self.get_devices()
+
+    def get_sample_size(self) -> int:
+        if self._sample_size is None:
+            self._sample_size = self.backend.get_sample_size()
+        return self._sample_size
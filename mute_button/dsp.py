@@ -0,0 +1,209 @@
+import math
+
+import numpy as np
+
+
+TAPS_PER_PHASE = 16
+ROLLOFF = 0.92
+KAISER_BETA = 8.0
+FADE_SECONDS = 0.005
+
+
+def channel_mix_matrix(in_channels: int, out_channels: int) -> np.ndarray:
+    """ Matrix mapping input to output channels: mono is duplicated, other down-mixes average the input channels
+    folded onto each output channel and other up-mixes copy the input channels and leave the rest silent.
+    """
+    matrix = np.zeros((in_channels, out_channels), dtype=np.float32)
+    if in_channels == 1:
+        matrix[0, :] = 1.0
+    elif out_channels == 1:
+        matrix[:, 0] = 1.0 / in_channels
+    elif in_channels > out_channels:
+        for i in range(in_channels):
+            matrix[i, i % out_channels] = 1.0
+        matrix /= matrix.sum(axis=0, keepdims=True)
+    else:
+        matrix[np.arange(in_channels), np.arange(in_channels)] = 1.0
+    return matrix
+
+
+class PolyphaseResampler:
+    """ Streaming rational resampler (up / down) with a Kaiser windowed sinc low-pass filter.
+
+    All intermediate arrays are preallocated for blocks of up to max_frames input frames.
+    """
+    def __init__(self, in_rate: int, out_rate: int, channels: int, max_frames: int):
+        divisor = math.gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.channels = channels
+        self.taps = TAPS_PER_PHASE
+        length = self.up * self.taps
+        cutoff = ROLLOFF * 0.5 / max(self.up, self.down)
+        n = np.arange(length) - (length - 1) / 2
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, KAISER_BETA) * self.up
+        # phase_filters[p, k] is the coefficient applied to input sample base - k for output phase p
+        self.phase_filters = np.ascontiguousarray(h.reshape(self.taps, self.up).T, dtype=np.float32)
+        self._offsets = self.taps - 1 - np.arange(self.taps)
+        self._next = 0  # Position of the next output in upsampled samples, relative to the current block
+        self._allocate(max_frames)
+
+    def _allocate(self, max_frames: int):
+        self.max_frames = max_frames
+        max_out = max_frames * self.up // self.down + 2
+        self._input = np.zeros((max_frames + self.taps - 1, self.channels), dtype=np.float32)
+        self._steps = np.arange(max_out, dtype=np.int64) * self.down
+        self._positions = np.empty(max_out, dtype=np.int64)
+        self._base = np.empty(max_out, dtype=np.int64)
+        self._phase = np.empty(max_out, dtype=np.int64)
+        self._indices = np.empty((max_out, self.taps), dtype=np.int64)
+        self._coefficients = np.empty((max_out, self.taps), dtype=np.float32)
+        self._gathered = np.empty((max_out, self.taps, self.channels), dtype=np.float32)
+        self._output = np.empty((max_out, self.channels), dtype=np.float32)
+
+    def output_frames(self, frames: int) -> int:
+        total = frames * self.up - self._next
+        return max(0, -(-total // self.down))
+
+    def process(self, frames: np.ndarray) -> np.ndarray:
+        """ Resample a (frames, channels) float32 block. Returns a view that is valid until the next call.
+        """
+        n = len(frames)
+        if n > self.max_frames:
+            history = self._input[:self.taps - 1].copy()
+            self._allocate(n)
+            self._input[:self.taps - 1] = history
+        k = self.taps - 1
+        self._input[k:k + n] = frames
+        n_out = self.output_frames(n)
+        positions = np.add(self._steps[:n_out], self._next, out=self._positions[:n_out])
+        base = np.floor_divide(positions, self.up, out=self._base[:n_out])
+        phase = np.remainder(positions, self.up, out=self._phase[:n_out])
+        indices = np.add(base[:, None], self._offsets, out=self._indices[:n_out])
+        coefficients = np.take(self.phase_filters, phase, axis=0, out=self._coefficients[:n_out])
+        gathered = np.take(self._input, indices, axis=0, out=self._gathered[:n_out])
+        output = np.einsum('nk,nkc->nc', coefficients, gathered, out=self._output[:n_out])
+        self._next += n_out * self.down - n * self.up
+        # Keep the last taps - 1 input frames as history for the next block
+        self._input[:k] = self._input[n:n + k]
+        return output
+
+
+class GainRamp:
+    """ Per-frame gain that moves linearly towards its target, reaching it within ramp_frames frames.
+
+    The target can change at any frame offset inside a block, so mute decisions take effect at the frame they
+    were made instead of at the next buffer boundary.
+    """
+    def __init__(self, ramp_frames: int, max_frames: int):
+        self.gain = 1.0
+        self._step = 1.0 / max(1, ramp_frames)
+        self._allocate(max_frames)
+
+    def _allocate(self, max_frames: int):
+        self.max_frames = max_frames
+        self._ramp = np.arange(1, max_frames + 1, dtype=np.float32) * np.float32(self._step)
+        self._curve = np.empty(max_frames, dtype=np.float32)
+
+    def is_unity(self, target: float, changes=()) -> bool:
+        return self.gain == 1.0 and target == 1.0 and len(changes) == 0
+
+    def apply(self, frames: np.ndarray, target: float, changes=()):
+        """ Scale (frames, channels) float32 frames in place. target applies from the first frame and changes is a
+        sorted list of (frame offset, target) pairs.
+        """
+        n = len(frames)
+        if n > self.max_frames:
+            self._allocate(n)
+        if len(changes) == 0 and self.gain == target:
+            if target == 0.0:
+                frames.fill(0.0)
+            elif target != 1.0:
+                frames *= np.float32(target)
+            return
+        offsets = [0] + [min(max(offset, 0), n) for offset, _ in changes] + [n]
+        targets = [target] + [change_target for _, change_target in changes]
+        for start, end, segment_target in zip(offsets[:-1], offsets[1:], targets):
+            if end <= start:
+                continue
+            curve = self._curve[start:end]
+            if self.gain == segment_target:
+                curve.fill(segment_target)
+            else:
+                direction = 1.0 if segment_target > self.gain else -1.0
+                np.multiply(self._ramp[:end - start], np.float32(direction), out=curve)
+                curve += np.float32(self.gain)
+                np.clip(curve, min(self.gain, segment_target), max(self.gain, segment_target), out=curve)
+                self.gain = float(curve[-1])
+        np.multiply(frames, self._curve[:n, None], out=frames)
+
+
+class FormatConverter:
+    """ Converts interleaved int16 buffers from the capture format to the playback format.
+
+    Converts to float32, remaps channels and resamples on preallocated buffers. Channels are mapped before
+    resampling when that reduces the number of channels to resample and after it otherwise.
+    """
+    def __init__(self, in_rate: int, in_channels: int, out_rate: int, out_channels: int, max_frames: int):
+        self.in_rate = in_rate
+        self.in_channels = in_channels
+        self.out_rate = out_rate
+        self.out_channels = out_channels
+        self.passthrough = in_rate == out_rate and in_channels == out_channels
+        self._mix = channel_mix_matrix(in_channels, out_channels)
+        self._mix_first = out_channels <= in_channels
+        self._resampler = None
+        if in_rate != out_rate:
+            self._resampler = PolyphaseResampler(in_rate, out_rate, out_channels if self._mix_first else in_channels, max_frames)
+        self._allocate(max_frames)
+
+    def _allocate(self, max_frames: int):
+        self.max_frames = max_frames
+        max_out = max_frames * self.out_rate // self.in_rate + 2
+        self._input = np.empty((max_frames, self.in_channels), dtype=np.float32)
+        self._mixed_input = np.empty((max_frames, self.out_channels), dtype=np.float32)
+        self._mixed_output = np.empty((max_out, self.out_channels), dtype=np.float32)
+        self._output = np.empty((max_out, self.out_channels), dtype=np.int16)
+
+    def to_float(self, in_data) -> np.ndarray:
+        """ Interleaved int16 bytes as a (frames, channels) float32 view valid until the next call.
+        """
+        samples = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.in_channels)
+        if len(samples) > self.max_frames:
+            self._allocate(len(samples))
+        return np.multiply(samples, np.float32(1 / 32768), out=self._input[:len(samples)])
+
+    def convert(self, frames: np.ndarray) -> np.ndarray:
+        """ Remap and resample a float32 block from to_float() to the output format.
+        """
+        if self._mix_first:
+            if self.in_channels != self.out_channels:
+                frames = np.matmul(frames, self._mix, out=self._mixed_input[:len(frames)])
+            if self._resampler is not None:
+                frames = self._resampler.process(frames)
+        else:
+            if self._resampler is not None:
+                frames = self._resampler.process(frames)
+            frames = np.matmul(frames, self._mix, out=self._mixed_output[:len(frames)])
+        return frames
+
+    def to_int16(self, frames: np.ndarray) -> memoryview:
+        """ Clip and convert float32 frames to interleaved int16 bytes valid until the next call.
+        """
+        output = self._output[:len(frames)]
+        np.multiply(frames, 32768, out=frames)
+        np.clip(frames, -32768, 32767, out=frames)
+        np.rint(frames, out=frames)
+        np.copyto(output, frames, casting='unsafe')
+        return output.data.cast('B')
+
+    def process(self, in_data, gain: GainRamp | None = None, target: float = 1.0, changes=()):
+        """ Convert an interleaved int16 buffer in the capture format to the playback format, applying gain with
+        the given target and changes in the capture format.
+        """
+        if self.passthrough and (gain is None or gain.is_unity(target, changes)):
+            return in_data
+        frames = self.to_float(in_data)
+        if gain is not None:
+            gain.apply(frames, target, changes)
+        return self.to_int16(self.convert(frames))
@@ -0,0 +1,57 @@
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+
+import numpy as np
+import soundfile as sf
+
+
+# Speaker samples are stored losslessly for featurization, recordings are played back in the browser from a lossy copy
+STORAGE_EXTENSION = '.flac'
+PLAYBACK_EXTENSION = '.ogg'
+# Sample rates supported by Opus, recordings at other rates are played back as Vorbis
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+ENCODER_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+# Length of the blocks audio files are streamed in
+BLOCK_SECONDS = 10
+
+
+@functools.cache
+def get_encoder_pool() -> concurrent.futures.ProcessPoolExecutor:
+    # Workers are spawned rather than forked because the server process runs audio threads
+    return concurrent.futures.ProcessPoolExecutor(ENCODER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+async def run_in_encoder_pool(function, *args):
+    """ Run a module level function in the encoder process pool without blocking the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_encoder_pool(), function, *args)
+
+
+def read_audio(path: str) -> tuple[np.ndarray, int]:
+    """ Decode an audio file to (frames, channels) int16 samples and return them with the sample rate.
+    """
+    return sf.read(path, dtype='int16', always_2d=True)
+
+
+def open_audio_writer(path: str, rate: int, channels: int) -> sf.SoundFile:
+    """ Open a file for writing int16 samples in the format given by the extension: FLAC, Opus or Vorbis in OGG, or WAV.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.ogg':
+        return sf.SoundFile(path, 'w', rate, channels, format='OGG', subtype='OPUS' if rate in OPUS_RATES else 'VORBIS')
+    elif extension == '.flac':
+        return sf.SoundFile(path, 'w', rate, channels, format='FLAC', subtype='PCM_16')
+    else:
+        return sf.SoundFile(path, 'w', rate, channels, format='WAV', subtype='PCM_16')
+
+
+def encode_file(src: str, dst: str) -> str:
+    # Streamed in blocks so that long takes are never held in memory
+    info = sf.info(src)
+    with open_audio_writer(dst, info.samplerate, info.channels) as output:
+        for block in sf.blocks(src, blocksize=BLOCK_SECONDS * info.samplerate, dtype='int16', always_2d=True):
+            output.write(block)
+    return dst
@@ -0,0 +1,94 @@
+import numpy as np
+
+from mute_button.dsp import FADE_SECONDS
+from mute_button.ring_buffer import RingBuffer
+
+
+class JitterBuffer:
+    """ Hands converted audio from the capture callback to an independent playback callback.
+
+    Playback starts once target_frames are buffered. When the buffer runs dry the missing frames are played as
+    silence and playback waits for the target depth again; when clock drift or a stall lets the depth grow past
+    target_frames + burst_frames, the oldest frames are dropped to get back to the target, crossfading from the
+    dropped audio over FADE_SECONDS so that the cut does not click. burst_frames is the largest amount of audio
+    either side moves at once.
+    """
+    LATENCY_SMOOTHING = 0.05
+
+    def __init__(self, rate: int, channels: int, target_frames: int, burst_frames: int):
+        self.rate = rate
+        self.target_frames = target_frames
+        self.burst_frames = burst_frames
+        self.ring = RingBuffer(target_frames + 4 * burst_frames, channels)
+        self.underruns = 0
+        self.resyncs = 0
+        self.dropped_frames = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self._input_latency = 0.0
+        self._playing = False
+        self._silence = bytes(burst_frames * self.ring.frame_size)
+        fade_frames = max(1, int(rate * FADE_SECONDS))
+        self._fade_in = ((np.arange(fade_frames, dtype=np.float32) + 1) / (fade_frames + 1))[:, np.newaxis]
+
+    def write(self, data, input_latency: float = 0.0):
+        """ Queue frames for playback (capture side). input_latency is the age of the buffer's first frame.
+        """
+        self._input_latency = input_latency
+        self.ring.write(data)
+
+    def can_write(self, frame_count: int) -> bool:
+        """ Whether playback reading frame_count frames at a time still waits for more audio, so that another write
+        neither leaves it waiting nor grows the buffer past the depth at which frames are dropped.
+        """
+        return self.ring.available() < max(self.target_frames, frame_count)
+
+    def can_read(self, frame_count: int) -> bool:
+        """ Whether read(frame_count) would return buffered audio without padding it with silence.
+        """
+        return self.ring.available() >= (frame_count if self._playing else max(self.target_frames, frame_count))
+
+    def read(self, frame_count: int, output_latency: float = 0.0) -> bytes:
+        """ Return exactly frame_count frames for playback (playback side), padded with silence if necessary.
+        """
+        depth = self.ring.available()
+        dropped = None
+        if not self._playing:
+            if depth < max(self.target_frames, frame_count):
+                return self._get_silence(frame_count)
+            self._playing = True
+        elif depth > self.target_frames + self.burst_frames:
+            excess = depth - self.target_frames
+            # The start of the dropped audio is faded out under the start of the audio played from now on
+            fade_frames = min(len(self._fade_in), excess)
+            dropped = self.ring.read(fade_frames)
+            self.ring.advance(excess - fade_frames)
+            self.resyncs += 1
+            self.dropped_frames += excess
+            depth -= excess
+        latency = self._input_latency + depth / self.rate + output_latency
+        self.latency += self.LATENCY_SMOOTHING * (latency - self.latency)
+        self.max_latency = max(self.max_latency, latency)
+        data = self.ring.read(frame_count)
+        if dropped:
+            data = self._crossfade(dropped, data)
+        if len(data) < frame_count * self.ring.frame_size:
+            self.underruns += 1
+            self._playing = False
+            data += self._get_silence(frame_count - len(data) // self.ring.frame_size)
+        return data
+
+    def _crossfade(self, dropped: bytes, data: bytes) -> bytes:
+        channels = self.ring.channels
+        faded = np.frombuffer(data, dtype=np.int16).reshape(-1, channels).copy()
+        n = min(len(faded), len(dropped) // self.ring.frame_size)
+        fade_in = self._fade_in[:n]
+        mixed = faded[:n] * fade_in + np.frombuffer(dropped, dtype=np.int16).reshape(-1, channels)[:n] * (1 - fade_in)
+        faded[:n] = np.clip(np.rint(mixed), -32768, 32767)
+        return faded.tobytes()
+
+    def _get_silence(self, frame_count: int) -> bytes:
+        size = frame_count * self.ring.frame_size
+        if size > len(self._silence):
+            self._silence = bytes(size)
+        return self._silence[:size]
@@ -0,0 +1,79 @@
+import math
+
+import numpy as np
+
+
+WAVEFORM_COLUMNS = 100
+WAVEFORM_HEIGHT = 40  # Height of the displayed waveform in view box units, its width is WAVEFORM_COLUMNS
+WAVEFORM_SECONDS = 5.0
+FLOOR_DB = -60.0
+
+
+def to_db(level: float) -> float:
+    return max(FLOOR_DB, 20.0 * math.log10(level)) if level > 0 else FLOOR_DB
+
+
+class LevelMeter:
+    """ Peak and RMS level of the latest buffer of a 16 bit stream and a waveform of the peak levels over the last
+    WAVEFORM_SECONDS, for display.
+
+    push() is called from an audio callback and only works on preallocated arrays. The waveform is a ring of
+    WAVEFORM_COLUMNS column peaks; readers copy it without a lock and at worst see a column that is being written.
+    """
+    def __init__(self, rate: int, channels: int, max_frames: int):
+        self.column_samples = max(1, int(rate * WAVEFORM_SECONDS / WAVEFORM_COLUMNS)) * channels
+        self.peak = 0.0
+        self.rms = 0.0
+        self.columns = 0  # Completed columns since creation, the next one goes to columns % WAVEFORM_COLUMNS
+        self._column_peaks = np.zeros(WAVEFORM_COLUMNS, dtype=np.float32)
+        self._column_peak = 0.0
+        self._column_fill = 0
+        self._allocate(max_frames * channels)
+
+    def _allocate(self, max_samples: int):
+        self._levels = np.empty(max_samples, dtype=np.float32)
+        self._block_peaks = np.empty(max_samples // self.column_samples + 1, dtype=np.float32)
+
+    def _add_columns(self, peaks: np.ndarray):
+        start = self.columns % WAVEFORM_COLUMNS
+        first = min(len(peaks), WAVEFORM_COLUMNS - start)
+        self._column_peaks[start:start + first] = peaks[:first]
+        self._column_peaks[:len(peaks) - first] = peaks[first:]
+        self.columns += len(peaks)
+
+    def push(self, data):
+        """ Measure a buffer of interleaved int16 samples.
+        """
+        samples = np.frombuffer(data, dtype=np.int16)
+        n = len(samples)
+        if n == 0:
+            return
+        if n > len(self._levels):
+            self._allocate(n)
+        levels = np.multiply(samples, np.float32(1 / 32768), out=self._levels[:n])
+        self.rms = math.sqrt(float(np.dot(levels, levels)) / n)
+        np.abs(levels, out=levels)
+        self.peak = float(levels.max())
+        # Fill up the current column, then add whole columns and keep the rest for the next buffer
+        size = self.column_samples
+        head = min(n, size - self._column_fill)
+        self._column_peak = max(self._column_peak, float(levels[:head].max()))
+        self._column_fill += head
+        if self._column_fill == size:
+            self._block_peaks[0] = self._column_peak
+            self._add_columns(self._block_peaks[:1])
+            self._column_peak = 0.0
+            self._column_fill = 0
+        whole = (n - head) // size
+        if whole > 0:
+            self._add_columns(levels[head:head + whole * size].reshape(whole, size).max(axis=1, out=self._block_peaks[:whole]))
+        tail = levels[head + whole * size:]
+        if len(tail) > 0:
+            self._column_peak = float(tail.max())
+            self._column_fill = len(tail)
+
+    def waveform(self) -> np.ndarray:
+        """ Copy of the column peaks, oldest first.
+        """
+        start = self.columns % WAVEFORM_COLUMNS
+        return np.concatenate([self._column_peaks[start:], self._column_peaks[:start]])
@@ -0,0 +1,116 @@
+import bisect
+import math
+
+from mute_button.audio_backend import INPUT_OVERFLOW, INPUT_UNDERFLOW, OUTPUT_OVERFLOW, OUTPUT_UNDERFLOW
+
+
+# Bucket upper bounds in seconds
+CALLBACK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+BUFFER_DEPTH_BUCKETS = (0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.56, 5.12)
+STREAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATUS_FLAGS = {
+    'input_underflow': INPUT_UNDERFLOW,
+    'input_overflow': INPUT_OVERFLOW,
+    'output_underflow': OUTPUT_UNDERFLOW,
+    'output_overflow': OUTPUT_OVERFLOW,
+}
+
+
+class Histogram:
+    """ Histogram with fixed buckets and preallocated counts, cheap enough to observe from the audio callbacks.
+
+    Each histogram is written by a single thread and read by scrapes without a lock.
+    """
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """ Upper bound of the bucket containing the q quantile, inf above the last bucket and None without data.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+
+class RouteMetrics:
+    """ Counters of one audio route, kept across reopening the route so that they only ever increase.
+    """
+    def __init__(self, name: str, labels: dict[str, str]):
+        self.name = name
+        self.labels = labels
+        self.input_callback_seconds = Histogram(CALLBACK_BUCKETS)
+        self.output_callback_seconds = Histogram(CALLBACK_BUCKETS)
+        self.playback_buffer_seconds = Histogram(BUFFER_DEPTH_BUCKETS)
+        self.status_flags = dict.fromkeys(STATUS_FLAGS, 0)
+        self.forwarded_bytes = 0
+        self.playback_underruns = 0
+
+    def count_status(self, status: int):
+        for name, flag in STATUS_FLAGS.items():
+            if status & flag:
+                self.status_flags[name] += 1
+
+
+class SessionMetrics:
+    """ Recording counters of one session.
+    """
+    def __init__(self):
+        self.recorded_bytes = 0
+        self.recording_buffer_seconds = Histogram(BUFFER_DEPTH_BUCKETS)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    return '+Inf' if value == math.inf else repr(value)
+
+
+class PrometheusWriter:
+    """ Collects samples in the Prometheus text exposition format, writing the HELP and TYPE lines of each metric once.
+    """
+    def __init__(self):
+        self.lines = []
+        self._described = set()
+
+    def _describe(self, name: str, metric_type: str, help_text: str):
+        if name not in self._described:
+            self._described.add(name)
+            self.lines.append('# HELP {} {}'.format(name, help_text))
+            self.lines.append('# TYPE {} {}'.format(name, metric_type))
+
+    def sample(self, name: str, metric_type: str, help_text: str, value: float, labels: dict[str, str] = None):
+        self._describe(name, metric_type, help_text)
+        self.lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+
+    def histogram(self, name: str, help_text: str, histogram: Histogram, labels: dict[str, str] = None):
+        self._describe(name, 'histogram', help_text)
+        labels = labels or {}
+        counts = list(histogram.counts)
+        cumulative = 0
+        for bound, count in zip(histogram.bounds + (math.inf,), counts):
+            cumulative += count
+            self.lines.append('{}_bucket{} {}'.format(name, _format_labels({**labels, 'le': _format_value(bound)}), cumulative))
+        self.lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(histogram.sum)))
+        self.lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+
+    def render(self) -> str:
+        return '\n'.join(self.lines) + '\n'
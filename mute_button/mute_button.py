@@ -1,20 +1,28 @@
 import asyncio
+import functools
+import inspect
 import logging as log
+import math
 import os
-import pyaudiowpatch as pyaudio
-import queue
 import reflex as rx
-import shutil
 import uuid
-import wave
-
-from collections import defaultdict
-
-# Patch must be imported before reflex_dynoselect to apply
-import mute_button.dynoselect_patch
-from reflex_dynoselect import dynoselect
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
 
+from mute_button.audio_backend import LOOPBACK_SUFFIX, create_audio_backend
+from mute_button.audio_engine import AudioEngine, SessionControl
 from mute_button.component_builders import *
+from mute_button.device_registry import DeviceRegistry
+from mute_button.encoding import PLAYBACK_EXTENSION, encode_file, run_in_encoder_pool
+from mute_button.level_meter import FLOOR_DB, WAVEFORM_HEIGHT, LevelMeter, to_db
+from mute_button.metrics import Histogram, PrometheusWriter
+from mute_button.recording import RecordingWriter
+from mute_button.recording_cache import RecordingCache
+from mute_button.speaker_id import SpeakerModel
+from mute_button.speaker_index import SpeakerIndex
+from mute_button.speaker_search import SpeakerSearch
+from mute_button.vad import save_voiced
 
 
 log.basicConfig(level=log.INFO)
@@ -23,32 +31,204 @@ UPLOAD_DIR = rx.get_upload_dir()
 AUDIO_DIR = os.path.join(UPLOAD_DIR, 'audio')
 SPEAKERS_DIR = os.path.join(AUDIO_DIR, 'speakers')
 RECORDING_DIR = os.path.join(AUDIO_DIR, 'tmp')
-os.makedirs(SPEAKERS_DIR, exist_ok=True)
-if os.path.exists(RECORDING_DIR):
-    shutil.rmtree(RECORDING_DIR)
-os.makedirs(RECORDING_DIR)
+SPEAKER_INDEX_DIR = os.path.join(AUDIO_DIR, 'index')
+# Limits of the temporary recordings, recordings shown in a connected session are kept regardless
+RECORDING_CACHE_MAX_BYTES = 1024 ** 3
+RECORDING_CACHE_MAX_AGE_SECONDS = 24 * 3600
+
+audio_backend = create_audio_backend()
+audio_engine = AudioEngine(audio_backend)
+device_registry = DeviceRegistry(audio_backend)
+
+client_audio_controls: dict[str, SessionControl] = {}
+client_recording_writers: dict[str, RecordingWriter] = {}
+# Set to wake a session's audio task when its audio settings change or its client disconnects
+client_audio_events: dict[str, asyncio.Event] = {}
+# Set and dropped when a client disconnects, so that its polling tasks stop even if a page reload reconnects it at once
+client_disconnect_events: dict[str, asyncio.Event] = {}
+# Fallback in case a disconnect notification is missed
+STALE_CHECK_SECONDS = 30
+STATS_INTERVAL = 1
+# Level meters and waveforms are pushed to a session at most this often and only when they change
+LEVEL_INTERVAL = 0.1
+
+# Playback buffer depth between the capture and playback callbacks
+PLAYBACK_BUFFER_OPTIONS = ['10', '20', '40', '80', '160']
+
+# Speakers shown at once in the speaker picker
+SPEAKER_PAGE_SIZE = 50
+
+# Length in seconds of the voiced chunks a saved sample is split into
+SAMPLE_CHUNK_OPTIONS = {
+    'Whole sample': None,
+    '5 s chunks': 5.0,
+    '10 s chunks': 10.0,
+    '30 s chunks': 30.0,
+}
+
+# Stream buffer durations in seconds
+BUFFER_PRESETS = {
+    'Low latency (10 ms)': 0.01,
+    'Balanced (50 ms)': 0.05,
+    'Throughput (100 ms)': 0.1,
+}
+XRUN_COUNTERS = ['callbacks', 'input_overflows', 'output_underflows', 'playback_underruns']
+# Process-wide callback and xrun counts per buffer preset
+buffer_preset_xruns = {preset: dict.fromkeys(XRUN_COUNTERS, 0) for preset in BUFFER_PRESETS}
+
+def _get_buffer_preset_report() -> list[list[str]]:
+    return [[preset] + [str(xruns[counter]) for counter in XRUN_COUNTERS] for preset, xruns in buffer_preset_xruns.items()]
+
+def _format_quantile(histogram: Histogram, q: float) -> str:
+    value = histogram.quantile(q)
+    if value is None:
+        return '-'
+    elif value == math.inf:
+        return '> {:g} ms'.format(histogram.bounds[-1] * 1000)
+    return '≤ {:g} ms'.format(value * 1000)
+
+def _get_audio_stats(control: SessionControl | None) -> list[list[str]]:
+    route = control.route if control is not None else None
+    if route is None:
+        return []
+    metrics = route.metrics
+    callbacks = metrics.input_callback_seconds
+    load = callbacks.sum / (callbacks.count * route.buffer_seconds) if callbacks.count > 0 else 0.0
+    return [
+        ['Callback time (p50 / p99)', '{} / {}'.format(_format_quantile(callbacks, 0.5), _format_quantile(callbacks, 0.99))],
+        ['Callback load', '{:.1f} %'.format(100 * load)],
+        ['Playback buffer (p99)', _format_quantile(metrics.playback_buffer_seconds, 0.99)],
+        ['Xrun status flags', str(sum(metrics.status_flags.values()))],
+        ['Forwarded', '{:.1f} MB'.format(metrics.forwarded_bytes / 1e6)],
+        ['Recorded by this session', '{:.1f} MB'.format(control.metrics.recorded_bytes / 1e6)],
+        ['Sessions on this route', str(len(route.controls))],
+    ]
+
+def _get_levels(meter: LevelMeter | None) -> tuple[int, int, str]:
+    # Rounded to whole dB and waveform pixels so that steady audio does not cause updates
+    if meter is None:
+        return int(FLOOR_DB), int(FLOOR_DB), ''
+    half = WAVEFORM_HEIGHT // 2
+    heights = [round(peak * half) for peak in meter.waveform().tolist()]
+    waveform = ''.join('M{} {}v{}'.format(i, half - height, 2 * height) for i, height in enumerate(heights) if height > 0)
+    return round(to_db(meter.rms)), round(to_db(meter.peak)), waveform
+
+async def metrics_endpoint(request):
+    writer = PrometheusWriter()
+    audio_engine.write_metrics(writer)
+    for preset, xruns in buffer_preset_xruns.items():
+        for counter, count in xruns.items():
+            writer.sample('mute_button_buffer_preset_events_total', 'counter', 'Callbacks and xruns per buffer preset.',
+                          count, {'preset': preset, 'event': counter})
+    controls = {client_token[:8]: control for client_token, control in list(client_audio_controls.items())}
+    for session, control in controls.items():
+        writer.sample('mute_button_recorded_bytes_total', 'counter', 'Bytes of audio recorded by a session.',
+                      control.metrics.recorded_bytes, {'session': session})
+    for session, control in controls.items():
+        writer.histogram('mute_button_recording_buffer_seconds', 'Audio waiting in a session\'s recording buffer after each write.',
+                         control.metrics.recording_buffer_seconds, {'session': session})
+    for session, control in controls.items():
+        if control.recording_buffer is not None:
+            writer.sample('mute_button_recording_dropped_frames_total', 'counter', 'Frames dropped from a session\'s full recording buffer.',
+                          control.recording_buffer.dropped_frames, {'session': session})
+    return PlainTextResponse(writer.render(), media_type='text/plain; version=0.0.4')
 
-client_audio_recording_queues = defaultdict(queue.Queue)
+@functools.cache
+def _get_speakers_dir() -> str:
+    os.makedirs(SPEAKERS_DIR, exist_ok=True)
+    return SPEAKERS_DIR
 
-def _get_speaker_options():
-    return [{'value': i, 'label': i} for i in os.listdir(SPEAKERS_DIR) if os.path.isdir(os.path.join(SPEAKERS_DIR, i))]
+@functools.cache
+def _get_recording_cache() -> RecordingCache:
+    recording_cache = RecordingCache(RECORDING_DIR, RECORDING_CACHE_MAX_BYTES, RECORDING_CACHE_MAX_AGE_SECONDS)
+    recording_cache.scan()
+    return recording_cache
 
-speaker_options = _get_speaker_options()
+@functools.cache
+def _get_speaker_search() -> SpeakerSearch:
+    return SpeakerSearch(entry.name for entry in os.scandir(_get_speakers_dir()) if entry.is_dir())
+
+@functools.cache
+def _get_speaker_index() -> SpeakerIndex:
+    return SpeakerIndex(_get_speakers_dir(), SPEAKER_INDEX_DIR)
+
+def _get_speaker_model() -> SpeakerModel:
+    return _get_speaker_index().get_model()
+
+def _notify_audio_task(client_token: str):
+    audio_event = client_audio_events.get(client_token)
+    if audio_event is not None:
+        audio_event.set()
+
+async def _poll(client_token: str, disconnect_event: asyncio.Event, interval: float) -> bool:
+    """ Wait for interval and return whether the client is still connected on the same connection.
+    """
+    try:
+        await asyncio.wait_for(disconnect_event.wait(), timeout=interval)
+    except asyncio.TimeoutError:
+        pass
+    return not disconnect_event.is_set() and client_token in app.event_namespace.token_to_sid
+
+def _watch_disconnects():
+    # Wrap the websocket disconnect handler once so that audio tasks of disconnected clients stop right away
+    namespace = app.event_namespace
+    if namespace is None or getattr(namespace, 'notifies_audio_tasks', False):
+        return
+    on_disconnect = namespace.on_disconnect
+    # python-socketio passes the disconnect reason, which reflex's handler may not take
+    takes_reason = len(inspect.signature(on_disconnect).parameters) > 1
+
+    def notifying_on_disconnect(sid, reason=None):
+        client_token = namespace.sid_to_token.get(sid)
+        result = on_disconnect(sid, reason) if takes_reason else on_disconnect(sid)
+        if client_token is not None:
+            _notify_audio_task(client_token)
+            disconnect_event = client_disconnect_events.pop(client_token, None)
+            if disconnect_event is not None:
+                disconnect_event.set()
+        return result
+
+    namespace.on_disconnect = notifying_on_disconnect
+    namespace.notifies_audio_tasks = True
 
 
 class State(rx.State):
     _device_map: dict
+    _device_version: int = 0
     _loopback_devices: dict
     loopback_device: str
     _playback_devices: dict
     playback_device: str
+    rescanning_devices: bool = False
     do_forward: bool = False
     do_mute: bool = False
     do_record: bool = False
     recording_exists: bool = False
     recording_path_cache: list = []
+    _recording_path: str = ''
     speaker_for_sample: str
+    speaker_query: str = ''
+    speaker_page: list[str] = []
+    speaker_page_start: int = 0
+    speaker_matches: int = 0
+    speaker_query_is_new: bool = False
     save_sample_disabled: bool = True
+    saving_sample: bool = False
+    sample_chunks: str = 'Whole sample'
+    mute_speakers: list[str] = []
+    playback_buffer_ms: str = '40'
+    buffer_preset: str = 'Balanced (50 ms)'
+    buffer_preset_report: list[list[str]] = []
+    latency_ms: int = 0
+    max_latency_ms: int = 0
+    playback_underruns: int = 0
+    audio_stats: list[list[str]] = []
+    input_rms_db: int = int(FLOOR_DB)
+    input_peak_db: int = int(FLOOR_DB)
+    input_waveform: str = ''
+    output_rms_db: int = int(FLOOR_DB)
+    output_peak_db: int = int(FLOOR_DB)
+    output_waveform: str = ''
 
     @rx.var
     def loopback_device_names(self) -> list:
@@ -57,6 +237,7 @@ class State(rx.State):
     @rx.event
     def set_loopback_device(self, value: str):
         self.loopback_device = value
+        _notify_audio_task(self.router.session.client_token)
 
     @rx.var
     def playback_device_names(self) -> list:
@@ -65,6 +246,17 @@ class State(rx.State):
     @rx.event
     def set_playback_device(self, value: str):
         self.playback_device = value
+        _notify_audio_task(self.router.session.client_token)
+
+    @rx.event
+    def set_playback_buffer_ms(self, value: str):
+        self.playback_buffer_ms = value
+        _notify_audio_task(self.router.session.client_token)
+
+    @rx.event
+    def set_buffer_preset(self, value: str):
+        self.buffer_preset = value
+        _notify_audio_task(self.router.session.client_token)
 
     def _get_device_warning(self) -> str:
         if len(self._loopback_devices) < 1 or len(self._playback_devices) < 1 or len(set(list(self._loopback_devices.keys()) + list(self._playback_devices.keys()))) < 2:
@@ -87,134 +279,364 @@ class State(rx.State):
     def devices_invalid(self) -> bool:
         return self._get_device_warning() != ''
 
+    def _update_audio_control(self):
+        control = client_audio_controls.get(self.router.session.client_token)
+        if control is not None:
+            control.forward = self.do_forward
+            control.mute = self.do_mute
+            control.record = self.do_record
+            control.mute_speakers = frozenset(self.mute_speakers)
+            route = control.route
+            if route is not None:
+                route.refresh_targets()
+
     @rx.event
     def toggle_forward(self, value: bool):
         self.do_forward = value
+        self._update_audio_control()
+
+    def _search_speakers(self):
+        speaker_search = _get_speaker_search()
+        self.speaker_page, self.speaker_matches = speaker_search.search(self.speaker_query, self.speaker_page_start, SPEAKER_PAGE_SIZE)
+        query = self.speaker_query.strip()
+        self.speaker_query_is_new = query != '' and query not in speaker_search
+
+    @rx.event
+    def load_speakers(self):
+        self._search_speakers()
+
+    @rx.event
+    def search_speakers(self, query: str):
+        self.speaker_query = query
+        self.speaker_page_start = 0
+        self._search_speakers()
+
+    @rx.event
+    def next_speaker_page(self):
+        if self.speaker_page_start + SPEAKER_PAGE_SIZE < self.speaker_matches:
+            self.speaker_page_start += SPEAKER_PAGE_SIZE
+            self._search_speakers()
+
+    @rx.event
+    def previous_speaker_page(self):
+        self.speaker_page_start = max(0, self.speaker_page_start - SPEAKER_PAGE_SIZE)
+        self._search_speakers()
+
+    @rx.var
+    def speaker_page_label(self) -> str:
+        if self.speaker_matches == 0:
+            return 'No speakers found'
+        return '{}-{} of {}'.format(self.speaker_page_start + 1, min(self.speaker_page_start + SPEAKER_PAGE_SIZE, self.speaker_matches), self.speaker_matches)
+
+    @rx.event
+    def toggle_mute_speaker(self, speaker: str, checked: bool):
+        if checked and speaker not in self.mute_speakers:
+            self.mute_speakers.append(speaker)
+        elif not checked and speaker in self.mute_speakers:
+            self.mute_speakers.remove(speaker)
+        self._update_audio_control()
 
     @rx.event
     def start_recording(self):
-        client_audio_recording_queues[self.router.session.client_token] = queue.Queue()
+        control = client_audio_controls.get(self.router.session.client_token)
+        route = control.route if control is not None else None
+        previous_writer = client_recording_writers.pop(self.router.session.client_token, None)
+        if previous_writer is not None:
+            previous_writer.discard()
+        recording_cache = _get_recording_cache()
+        recording_cache.unpin(self.router.session.client_token)
+        if route is not None:
+            control.recording_buffer.clear()
+            recording_path = os.path.join(recording_cache.directory, str(uuid.uuid4()) + '.wav')
+            client_recording_writers[self.router.session.client_token] = RecordingWriter(
+                control.recording_buffer, recording_path, route.input_rate, device_registry.get_sample_size()
+            )
         self.do_record = True
+        self._update_audio_control()
         self.recording_exists = False
         self.recording_path_cache = []
+        self._recording_path = ''
         self.save_sample_disabled = True
 
     @rx.event
     def stop_recording(self):
-        loopback_device_info = self._device_map.get(self._loopback_devices.get(self.loopback_device))
-        if loopback_device_info is not None:
-            q = client_audio_recording_queues[self.router.session.client_token]
-            recorded_frames = []
-            while not q.empty():
-                try:
-                    recorded_frames.append(q.get_nowait())
-                except queue.Empty:
-                    break
-            recording_path = os.path.join(RECORDING_DIR, str(uuid.uuid4()) + '.wav')
-            with wave.open(recording_path, 'wb') as wf:
-                wf.setnchannels(loopback_device_info['maxInputChannels']) # Input instead of output due to loopback
-                wf.setsampwidth(pyaudio.PyAudio().get_sample_size(pyaudio.paInt16))
-                wf.setframerate(int(loopback_device_info['defaultSampleRate']))
-                wf.writeframes(b''.join(recorded_frames))
+        self.do_record = False
+        self._update_audio_control()
+        control = client_audio_controls.get(self.router.session.client_token)
+        writer = client_recording_writers.pop(self.router.session.client_token, None)
+        if writer is not None:
+            writer.stop()
+            if control is not None and control.recording_buffer.overruns > 0:
+                log.warning('Recording buffer overrun, dropped {} frames.'.format(control.recording_buffer.dropped_frames))
+            recording_cache = _get_recording_cache()
+            recording_cache.pin(self.router.session.client_token, [writer.path])
+            recording_cache.add(writer.path)
             self.recording_exists = True
-            self.recording_path_cache = [os.path.relpath(recording_path, UPLOAD_DIR)]
+            self._recording_path = writer.path
+            self.recording_path_cache = [os.path.relpath(writer.path, UPLOAD_DIR)]
             self.save_sample_disabled = self.speaker_for_sample is None or self.speaker_for_sample == ''
-        client_audio_recording_queues[self.router.session.client_token] = queue.Queue()
-        self.do_record = False
+            return State.encode_recording
+
+    @rx.event(background=True)
+    async def encode_recording(self):
+        async with self:
+            client_token = self.router.session.client_token
+            recording_path = self._recording_path
+        if recording_path == '':
+            return
+        # The WAV is kept for analysis, the browser plays a compressed copy once it is ready
+        playback_path = os.path.splitext(recording_path)[0] + PLAYBACK_EXTENSION
+        try:
+            await run_in_encoder_pool(encode_file, recording_path, playback_path)
+        except (OSError, RuntimeError) as e:
+            log.warning('Could not encode recording {}: {}'.format(recording_path, e))
+            return
+        recording_cache = _get_recording_cache()
+        async with self:
+            if self._recording_path == recording_path:
+                recording_cache.pin(client_token, [recording_path, playback_path])
+                self.recording_path_cache = [os.path.relpath(playback_path, UPLOAD_DIR)]
+        recording_cache.add(playback_path)
 
     @rx.event
-    def select_speaker_for_sample(self, selected):
-        self.speaker_for_sample = selected.get('label', '')
+    def select_speaker_for_sample(self, speaker: str):
+        speaker = speaker.strip()
+        # Speaker names are directory names
+        if speaker in ('', '.', '..') or '/' in speaker or '\\' in speaker:
+            return rx.toast.error('Invalid speaker name ' + speaker)
+        # Names differing only in case are the same directory on Windows, so an existing speaker keeps its spelling
+        self.speaker_for_sample = _get_speaker_search().find(speaker) or speaker
         self.save_sample_disabled = not self.recording_exists
 
     @rx.event
-    def save_sample(self):
-        if len(self.speaker_for_sample) > 0 and len(self.recording_path_cache) > 0:
-            speaker_dir = os.path.join(SPEAKERS_DIR, self.speaker_for_sample)
-            os.makedirs(speaker_dir, exist_ok=True)
-            src = os.path.join(UPLOAD_DIR, self.recording_path_cache[0])
-            dst = os.path.join(speaker_dir, os.path.relpath(src, RECORDING_DIR))
-            shutil.copy(src, dst)
-            global speaker_options
-            speaker_options = _get_speaker_options()
-            yield rx.toast.success('Saved sample to speaker ' + self.speaker_for_sample)
-        else:
-            yield rx.toast.error('Could not save sample to speaker ' + self.speaker_for_sample)
+    def set_sample_chunks(self, value: str):
+        self.sample_chunks = value
 
-    @rx.event
-    def find_audio_devices(self):
-        with pyaudio.PyAudio() as pa:
-            wasapi_devices = pa.get_device_info_generator_by_host_api(host_api_type=pyaudio.paWASAPI)
-            self._device_map = {dev['index']: dev for dev in wasapi_devices}
-            self._loopback_devices = {dev['name'].removesuffix(' [Loopback]'): dev['index'] for dev in self._device_map.values() if dev['isLoopbackDevice']}
-            self._playback_devices = {dev['name']: dev['index'] for dev in self._device_map.values() if dev['maxOutputChannels'] > 0}
-            log.info('Found {} loopback device(s) and {} playback device(s)'.format(len(self._loopback_devices.keys()), len(self._playback_devices.keys())))
-
-    def _create_audio_callback(self, output_stream, client_token):
-        def callback(in_data, frame_count, time_info, status):
-            if self.do_forward and not self.do_mute:
-                output_stream.write(in_data)
-            if self.do_record:
-                client_audio_recording_queues[client_token].put(in_data)
-            return in_data, pyaudio.paContinue
-        return callback
+    @rx.event(background=True)
+    async def save_sample(self):
+        async with self:
+            speaker = self.speaker_for_sample
+            recording_path = self._recording_path
+            chunk_seconds = SAMPLE_CHUNK_OPTIONS.get(self.sample_chunks)
+            if len(speaker) > 0 and recording_path != '':
+                self.saving_sample = True
+        if len(speaker) == 0 or recording_path == '':
+            yield rx.toast.error('Could not save sample to speaker ' + speaker)
+            return
+        # Silence trimming and FLAC encoding run in the encoder processes and featurization in a thread, so that
+        # long takes block neither the event loop nor each other
+        _get_recording_cache().touch(recording_path)
+        speaker = _get_speaker_search().find(speaker) or speaker
+        try:
+            sample_paths = await run_in_encoder_pool(save_voiced, recording_path, os.path.join(_get_speakers_dir(), speaker), chunk_seconds)
+            if len(sample_paths) > 0:
+                audio_engine.set_speaker_model(await asyncio.to_thread(_get_speaker_index().update))
+        except (OSError, RuntimeError) as e:
+            log.warning('Could not save sample {}: {}'.format(recording_path, e))
+            sample_paths = None
+        finally:
+            async with self:
+                self.saving_sample = False
+        if sample_paths is None:
+            yield rx.toast.error('Could not save sample to speaker ' + speaker)
+            return
+        elif len(sample_paths) == 0:
+            yield rx.toast.error('No speech found in the recording')
+            return
+        _get_speaker_search().add(speaker)
+        async with self:
+            self._search_speakers()
+        yield rx.toast.success('Saved {} sample(s) to speaker {}'.format(len(sample_paths), speaker))
+
+    def _load_devices(self, devices: list[dict]):
+        self._device_version = device_registry.version
+        self._device_map = {dev['index']: dev for dev in devices}
+        self._loopback_devices = {dev['name'].removesuffix(LOOPBACK_SUFFIX): dev['index'] for dev in self._device_map.values() if dev['isLoopbackDevice']}
+        self._playback_devices = {dev['name']: dev['index'] for dev in self._device_map.values() if dev['maxOutputChannels'] > 0}
+        _notify_audio_task(self.router.session.client_token)
+
+    @rx.event(background=True)
+    async def find_audio_devices(self):
+        # Enumerates only on first use and after device changes, all other page loads get the cached devices
+        devices = await asyncio.to_thread(device_registry.get_devices)
+        async with self:
+            self._load_devices(devices)
+
+    @rx.event(background=True)
+    async def rescan_audio_devices(self):
+        async with self:
+            self.rescanning_devices = True
+        devices = await asyncio.to_thread(device_registry.rescan)
+        async with self:
+            self._load_devices(devices)
+            self.rescanning_devices = False
 
     @rx.event(background=True)
     async def process_audio(self):
-        loopback_device = None
-        playback_device = None
-        audio_input_stream = None
-        audio_output_stream = None
+        client_token = self.router.session.client_token
+        settings = None
         processing = False
         stale = False
-        pa = pyaudio.PyAudio()
+        _watch_disconnects()
+        audio_event = client_audio_events.setdefault(client_token, asyncio.Event())
+        control = client_audio_controls.setdefault(client_token, SessionControl())
 
         while not stale:
-            if not processing:
-                async with self:
-                    if self.loopback_device != '' and self.playback_device != '' and self.loopback_device != self.playback_device:
-                        loopback_device = self.loopback_device
-                        playback_device = self.playback_device
-                        loopback_device_info = self._device_map.get(self._loopback_devices.get(self.loopback_device))
-                        playback_device_info = self._device_map.get(self._playback_devices.get(self.playback_device))
-                        if loopback_device_info and playback_device_info:
-                            input_sample_rate = int(loopback_device_info['defaultSampleRate'])
-                            frames_per_buffer = int(input_sample_rate / 20)
-                            audio_output_stream = pa.open(format=pyaudio.paInt16, channels=playback_device_info['maxOutputChannels'],
-                                                          rate=int(playback_device_info['defaultSampleRate']), frames_per_buffer=frames_per_buffer, output=True,
-                                                          output_device_index=playback_device_info['index'])
-                            client_audio_recording_queues[self.router.session.client_token] = queue.Queue()
-                            input_callback = self._create_audio_callback(audio_output_stream, self.router.session.client_token)
-                            audio_input_stream = pa.open(format=pyaudio.paInt16, channels=loopback_device_info['maxInputChannels'],
-                                                         rate=input_sample_rate, frames_per_buffer=frames_per_buffer, input=True,
-                                                         input_device_index=loopback_device_info['index'], stream_callback=input_callback)
+            # Cleared before reading the state so that changes made from now on wake the loop again
+            audio_event.clear()
+            model = await asyncio.to_thread(_get_speaker_model)
+            open_error = None
+            async with self:
+                stale = client_token not in app.event_namespace.token_to_sid
+                buffer_preset = self.buffer_preset if self.buffer_preset in BUFFER_PRESETS else 'Balanced (50 ms)'
+                # Device infos are part of the settings so that routes are reopened when a rescan changes them
+                loopback_device_info = self._device_map.get(self._loopback_devices.get(self.loopback_device))
+                playback_device_info = self._device_map.get(self._playback_devices.get(self.playback_device))
+                new_settings = (self.loopback_device, self.playback_device, self.playback_buffer_ms, buffer_preset, loopback_device_info, playback_device_info)
+                if processing and (stale or new_settings != settings):
+                    writer = client_recording_writers.pop(client_token, None)
+                    if writer is not None:
+                        writer.discard()
+                    audio_engine.unsubscribe(control)
+                    processing = False
+                    if not stale:
+                        self.do_record = False
+                    log.info('Stopped processing audio from {} to {}.'.format(settings[0], settings[1]))
+                if not processing and not stale and self.loopback_device != '' and self.playback_device != '' and self.loopback_device != self.playback_device:
+                    settings = new_settings
+                    loopback_device, playback_device, playback_buffer_ms, buffer_preset, loopback_device_info, playback_device_info = settings
+                    if loopback_device_info and playback_device_info:
+                        try:
+                            audio_engine.subscribe(control, loopback_device_info, playback_device_info, BUFFER_PRESETS[buffer_preset],
+                                                   int(playback_buffer_ms), model, buffer_preset_xruns[buffer_preset])
+                        except (OSError, ValueError) as e:
+                            # E.g. a device in exclusive use, retried on the next settings change or rescan
+                            open_error = e
+                            log.warning('Could not open audio from {} to {}: {}'.format(loopback_device, playback_device, e))
+                        else:
+                            self._update_audio_control()
                             processing = True
-                            log.info('Processing audio from {} to {}.'.format(loopback_device, playback_device))
-                if not processing:
-                    async with self:
-                        if self.router.session.client_token not in app.event_namespace.token_to_sid:
-                            stale = True
-                    await asyncio.sleep(1)
-            while processing:
-                async with self:
-                    if self.router.session.client_token not in app.event_namespace.token_to_sid:
-                        stale = True
-                    if stale or self.loopback_device != loopback_device or self.playback_device != playback_device:
-                        audio_input_stream.stop_stream()
-                        audio_input_stream.close()
-                        audio_output_stream.stop_stream()
-                        audio_output_stream.close()
-                        processing = False
-                        del client_audio_recording_queues[self.router.session.client_token]
-                        if not stale:
-                            self.do_record = False
-                        log.info('Stopped processing audio from {} to {}.'.format(loopback_device, playback_device))
-                if processing:
-                    await asyncio.sleep(1)
+                            log.info('Processing audio from {} to {} with {} buffers.'.format(loopback_device, playback_device, buffer_preset))
+            if open_error is not None:
+                yield rx.toast.error('Could not open the audio devices: {}'.format(open_error))
+            if not stale:
+                try:
+                    await asyncio.wait_for(audio_event.wait(), timeout=STALE_CHECK_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        if client_audio_events.get(client_token) is audio_event:
+            del client_audio_events[client_token]
+        if client_audio_controls.get(client_token) is control:
+            del client_audio_controls[client_token]
+            _get_recording_cache().unpin(client_token)
         log.info('Stale audio processing handler removed.')
 
+    @rx.event(background=True)
+    async def refresh_audio_stats(self):
+        client_token = self.router.session.client_token
+        last_stats = None
+        speaker_search = _get_speaker_search()
+        speaker_version = speaker_search.version
+        _watch_disconnects()
+        disconnect_event = client_disconnect_events.setdefault(client_token, asyncio.Event())
+        while await _poll(client_token, disconnect_event, STATS_INTERVAL):
+            # Speakers saved by other sessions show up in this session's search results
+            if speaker_search.version != speaker_version:
+                speaker_version = speaker_search.version
+                async with self:
+                    self._search_speakers()
+            # Devices changed by a rescan or a hot-plug are enumerated once and picked up by every session
+            if device_registry.stale:
+                await asyncio.to_thread(device_registry.get_devices)
+            if device_registry.version != self._device_version:
+                devices = await asyncio.to_thread(device_registry.get_devices)
+                async with self:
+                    self._load_devices(devices)
+            # Counters are read without the state lock, which is only taken when there is something new to show
+            control = client_audio_controls.get(client_token)
+            route = control.route if control is not None else None
+            jitter_buffer = route.jitter_buffer if route is not None else None
+            stats = (
+                round(jitter_buffer.latency * 1000) if jitter_buffer else 0,
+                round(jitter_buffer.max_latency * 1000) if jitter_buffer else 0,
+                jitter_buffer.underruns if jitter_buffer else 0,
+                _get_buffer_preset_report(),
+                _get_audio_stats(control),
+            )
+            if stats != last_stats:
+                async with self:
+                    self.latency_ms, self.max_latency_ms, self.playback_underruns, self.buffer_preset_report, self.audio_stats = stats
+                last_stats = stats
+        if client_disconnect_events.get(client_token) is disconnect_event:
+            del client_disconnect_events[client_token]
+
+    @rx.event(background=True)
+    async def refresh_levels(self):
+        client_token = self.router.session.client_token
+        last_levels = None
+        _watch_disconnects()
+        disconnect_event = client_disconnect_events.setdefault(client_token, asyncio.Event())
+        while await _poll(client_token, disconnect_event, LEVEL_INTERVAL):
+            control = client_audio_controls.get(client_token)
+            route = control.route if control is not None else None
+            levels = _get_levels(route.input_meter if route else None) + _get_levels(route.output_meter if route else None)
+            if levels != last_levels:
+                async with self:
+                    (self.input_rms_db, self.input_peak_db, self.input_waveform,
+                     self.output_rms_db, self.output_peak_db, self.output_waveform) = levels
+                last_levels = levels
+        if client_disconnect_events.get(client_token) is disconnect_event:
+            del client_disconnect_events[client_token]
+
+
+def speaker_picker(trigger: rx.Component, on_select, allow_create: bool) -> rx.Component:
+    """ Popover with the paged speaker search, calling on_select with the chosen speaker.
+    """
+    create_button = rx.cond(
+        State.speaker_query_is_new,
+        rx.popover.close(
+            rx.button('Create new "', State.speaker_query, '"', variant='ghost', width='100%', justify='start',
+                      on_click=on_select(State.speaker_query)),
+        ),
+    ) if allow_create else rx.fragment()
+    return rx.popover.root(
+        rx.popover.trigger(trigger),
+        rx.popover.content(
+            rx.vstack(
+                rx.input(value=State.speaker_query, on_change=State.search_speakers, placeholder='Search', width='100%'),
+                rx.scroll_area(
+                    rx.vstack(
+                        create_button,
+                        rx.foreach(
+                            State.speaker_page,
+                            lambda speaker: rx.popover.close(
+                                rx.button(speaker, variant='ghost', width='100%', justify='start', on_click=on_select(speaker)),
+                            )
+                        ),
+                        spacing='1',
+                        width='100%',
+                    ),
+                    scrollbars='vertical',
+                    height='240px',
+                ),
+                rx.hstack(
+                    rx.icon_button(rx.icon('chevron_left', size=16), size='1', variant='ghost', on_click=State.previous_speaker_page,
+                                   disabled=State.speaker_page_start == 0),
+                    rx.text(State.speaker_page_label, size='1', color_scheme='gray'),
+                    rx.icon_button(rx.icon('chevron_right', size=16), size='1', variant='ghost', on_click=State.next_speaker_page,
+                                   disabled=State.speaker_page_start + SPEAKER_PAGE_SIZE >= State.speaker_matches),
+                    justify='between',
+                    align='center',
+                    width='100%',
+                ),
+                spacing='2',
+                width='260px',
+            ),
+        ),
+    )
+
 
-@rx.page(on_load=[State.find_audio_devices, State.process_audio])
+@rx.page(on_load=[State.find_audio_devices, State.load_speakers, State.process_audio, State.refresh_audio_stats, State.refresh_levels])
 def index() -> rx.Component:
     return rx.container(
         rx.color_mode.button(position='top-right'),
@@ -232,6 +654,16 @@ def index() -> rx.Component:
                                 rx.select(State.playback_device_names, value=State.playback_device, on_change=State.set_playback_device, width='350px'),
                                 'Playback device'
                             ),
+                            labeled_component(
+                                rx.select(PLAYBACK_BUFFER_OPTIONS, value=State.playback_buffer_ms, on_change=State.set_playback_buffer_ms, width='350px'),
+                                'Playback buffer (ms)'
+                            ),
+                            labeled_component(
+                                rx.select(list(BUFFER_PRESETS.keys()), value=State.buffer_preset, on_change=State.set_buffer_preset, width='350px'),
+                                'Buffer size'
+                            ),
+                            rx.button(rx.icon('refresh_cw', size=16), 'Rescan devices', variant='surface', color_scheme='gray',
+                                      on_click=State.rescan_audio_devices, loading=State.rescanning_devices),
                             spacing='4',
                         ),
                         title='Audio devices',
@@ -245,6 +677,37 @@ def index() -> rx.Component:
                             icon='triangle_alert', variant='surface', color_scheme='red', role='alert', width='100%'
                         ),
                     ),
+                    titled_card(
+                        rx.table.root(
+                            rx.table.header(
+                                rx.table.row(
+                                    *[rx.table.column_header_cell(header) for header in ['Buffer size', 'Callbacks', 'Input overflows', 'Output underflows', 'Playback underruns']]
+                                ),
+                            ),
+                            rx.table.body(
+                                rx.foreach(
+                                    State.buffer_preset_report,
+                                    lambda row: rx.table.row(rx.foreach(row, lambda cell: rx.table.cell(cell)))
+                                ),
+                            ),
+                            size='1',
+                        ),
+                        title='Buffer xruns',
+                        title_spacing='4'
+                    ),
+                    titled_card(
+                        rx.table.root(
+                            rx.table.body(
+                                rx.foreach(
+                                    State.audio_stats,
+                                    lambda row: rx.table.row(rx.table.row_header_cell(row[0]), rx.table.cell(row[1]))
+                                ),
+                            ),
+                            size='1',
+                        ),
+                        title='Audio pipeline',
+                        title_spacing='4'
+                    ),
                     width='100%',
                     flex='1',
                 ),
@@ -255,6 +718,18 @@ def index() -> rx.Component:
                                 rx.switch(checked=State.do_forward, on_change=State.toggle_forward, disabled=State.devices_invalid),
                                 'Forward audio from capture to playback device'
                             ),
+                            rx.text(
+                                'Latency ', State.latency_ms, ' ms (max ', State.max_latency_ms, ' ms), ', State.playback_underruns, ' playback underrun(s)',
+                                size='1', color_scheme='gray',
+                            ),
+                            labeled_component(
+                                rx.vstack(
+                                    level_meter('Captured', State.input_rms_db, State.input_peak_db, State.input_waveform),
+                                    level_meter('Forwarded', State.output_rms_db, State.output_peak_db, State.output_waveform),
+                                    width='100%',
+                                ),
+                                'Audio levels'
+                            ),
                             labeled_component(
                                 rx.vstack(
                                     rx.hstack(
@@ -273,18 +748,47 @@ def index() -> rx.Component:
                                         )
                                     ),
                                     rx.hstack(
-                                        rx.button('Save sample to speaker', variant='surface', color_sheme='indigo', width='177px', on_click=State.save_sample, disabled=State.save_sample_disabled),
-                                        dynoselect(
-                                            speaker_options,
-                                            create_option=dict(value='custom', label='Create new "{}"'),
-                                            placeholder='Select or add speaker',
-                                            search_placeholder='Search',
-                                            on_select=State.select_speaker_for_sample,
-                                        )
+                                        rx.button('Save sample to speaker', variant='surface', color_sheme='indigo', width='177px', on_click=State.save_sample,
+                                                  disabled=State.save_sample_disabled | State.saving_sample, loading=State.saving_sample),
+                                        speaker_picker(
+                                            rx.button(
+                                                rx.cond(
+                                                    State.speaker_for_sample == '',
+                                                    rx.text('Select or add speaker', color_scheme='gray'),
+                                                    rx.text(State.speaker_for_sample),
+                                                ),
+                                                rx.icon('chevron_down', size=16),
+                                                variant='surface', color_scheme='gray', width='200px', justify='between',
+                                            ),
+                                            State.select_speaker_for_sample,
+                                            allow_create=True,
+                                        ),
+                                        rx.select(list(SAMPLE_CHUNK_OPTIONS.keys()), value=State.sample_chunks, on_change=State.set_sample_chunks, width='130px'),
                                     ),
                                 ),
                                 'Audio sample recording'
                             ),
+                            labeled_component(
+                                rx.flex(
+                                    rx.foreach(
+                                        State.mute_speakers,
+                                        lambda speaker: rx.badge(
+                                            speaker,
+                                            rx.icon('x', size=12, cursor='pointer', on_click=State.toggle_mute_speaker(speaker, False)),
+                                            size='2', variant='surface',
+                                        )
+                                    ),
+                                    speaker_picker(
+                                        rx.button(rx.icon('plus', size=16), 'Add speaker', size='1', variant='soft'),
+                                        lambda speaker: State.toggle_mute_speaker(speaker, True),
+                                        allow_create=False,
+                                    ),
+                                    wrap='wrap',
+                                    align='center',
+                                    spacing='2',
+                                ),
+                                'Mute speakers'
+                            ),
                             spacing='4',
                         ),
                         title='Audio controls',
@@ -302,4 +806,4 @@ def index() -> rx.Component:
     )
 
 
-app = rx.App()
+app = rx.App(api_transformer=Starlette(routes=[Route('/metrics', metrics_endpoint)]))
@@ -0,0 +1,52 @@
+import os
+import threading
+import wave
+
+from mute_button.ring_buffer import RingBuffer
+
+
+class RecordingWriter:
+    """ Drains a RingBuffer into a WAV file from a background thread while recording.
+
+    Frames are appended as they arrive and the WAV header is fixed up when the writer is stopped, so stopping only
+    has to flush what arrived since the last drain.
+    """
+    DRAIN_INTERVAL = 0.1
+
+    def __init__(self, ring_buffer: RingBuffer, path: str, rate: int, sample_width: int = 2):
+        self.path = path
+        self.frames_written = 0
+        self._ring_buffer = ring_buffer
+        self._wf = wave.open(path, 'wb')
+        self._wf.setnchannels(ring_buffer.channels)
+        self._wf.setsampwidth(sample_width)
+        self._wf.setframerate(rate)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='recording-writer', daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        segments = self._ring_buffer.peek()
+        for segment in segments:
+            self._wf.writeframesraw(segment)
+        frames = sum(len(segment) for segment in segments) // self._ring_buffer.frame_size
+        self._ring_buffer.advance(frames)
+        self.frames_written += frames
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.DRAIN_INTERVAL):
+                self._drain()
+            self._drain()
+        finally:
+            # Closing writes the final frame count into the header
+            self._wf.close()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def discard(self):
+        self.stop()
+        if os.path.exists(self.path):
+            os.remove(self.path)
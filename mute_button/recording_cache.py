@@ -0,0 +1,98 @@
+import collections
+import logging as log
+import os
+import threading
+import time
+
+
+class RecordingCache:
+    """ Temporary recordings in a directory, capped in total size and age.
+
+    Files are evicted least recently used first, skipping files pinned by a session. Files left over from a previous
+    run are picked up by scan() and count towards the limits instead of being deleted up front.
+    """
+    def __init__(self, directory: str, max_bytes: int, max_age_seconds: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.total_bytes = 0
+        self._entries: collections.OrderedDict[str, tuple[int, float]] = collections.OrderedDict()  # Path to size and last use
+        self._pins: dict[str, frozenset[str]] = {}
+        self._lock = threading.Lock()
+
+    def scan(self):
+        """ Create the directory if needed and add the files already in it, oldest first.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+        with self._lock:
+            for mtime, path, size in sorted(files):
+                self._add(path, size, mtime)
+            self._evict()
+
+    def _add(self, path: str, size: int, last_used: float):
+        previous = self._entries.pop(path, None)
+        if previous is not None:
+            self.total_bytes -= previous[0]
+        self._entries[path] = (size, last_used)
+        self.total_bytes += size
+
+    def add(self, path: str):
+        """ Add a finished recording and evict others if the cache is over its limits.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            self._add(path, size, time.time())
+            self._evict()
+
+    def touch(self, path: str):
+        with self._lock:
+            if path in self._entries:
+                self._add(path, self._entries[path][0], time.time())
+
+    def pin(self, owner: str, paths):
+        """ Protect paths from eviction until owner pins other paths or is unpinned.
+        """
+        with self._lock:
+            self._pins[owner] = frozenset(paths)
+            for path in paths:
+                if path in self._entries:
+                    self._add(path, self._entries[path][0], time.time())
+
+    def unpin(self, owner: str):
+        with self._lock:
+            if self._pins.pop(owner, None):
+                self._evict()
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        pinned = frozenset().union(*self._pins.values())
+        expired = time.time() - self.max_age_seconds
+        removed = 0
+        for path, (size, last_used) in list(self._entries.items()):
+            if self.total_bytes <= self.max_bytes and last_used >= expired:
+                break
+            if path in pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning('Could not evict recording {}: {}'.format(path, e))
+                continue
+            del self._entries[path]
+            self.total_bytes -= size
+            removed += 1
+        if removed > 0:
+            log.info('Evicted {} recording(s), {:.1f} MB left in the recording cache.'.format(removed, self.total_bytes / 1e6))
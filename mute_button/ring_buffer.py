@@ -0,0 +1,84 @@
+class RingBuffer:
+    """ Preallocated single-producer/single-consumer ring buffer of 16 bit frames.
+
+    The producer (e.g. an audio callback) only moves the write position and the consumer only moves the read
+    position, so neither side needs a lock. Writes copy into the preallocated buffer; when the buffer is full the
+    frames that do not fit are dropped and counted as an overrun instead of overwriting unread data.
+    """
+    def __init__(self, capacity_frames: int, channels: int):
+        self.channels = channels
+        self.frame_size = channels * 2
+        self.capacity = capacity_frames
+        self._buffer = bytearray(capacity_frames * self.frame_size)
+        self._view = memoryview(self._buffer)
+        # Positions count frames since creation and only ever grow, the buffer offset is position % capacity
+        self._write_pos = 0
+        self._read_pos = 0
+        self.overruns = 0
+        self.dropped_frames = 0
+
+    def available(self) -> int:
+        return self._write_pos - self._read_pos
+
+    def free(self) -> int:
+        return self.capacity - (self._write_pos - self._read_pos)
+
+    def write(self, data) -> int:
+        """ Copy frames from a bytes-like object into the buffer (producer side). Returns the number of frames written.
+        """
+        src = memoryview(data).cast('B')
+        frames = len(src) // self.frame_size
+        free = self.capacity - (self._write_pos - self._read_pos)
+        if frames > free:
+            self.overruns += 1
+            self.dropped_frames += frames - free
+            frames = free
+        if frames == 0:
+            return 0
+        start = self._write_pos % self.capacity
+        first = min(frames, self.capacity - start)
+        fs = self.frame_size
+        self._view[start * fs:(start + first) * fs] = src[:first * fs]
+        if first < frames:
+            self._view[:(frames - first) * fs] = src[first * fs:frames * fs]
+        # Publish the frames only after they have been copied
+        self._write_pos += frames
+        return frames
+
+    def peek(self, max_frames: int | None = None) -> list[memoryview]:
+        """ Zero-copy views of up to max_frames readable frames (consumer side), split in two if they wrap around.
+
+        The views stay valid until advance() is called with their length.
+        """
+        frames = self._write_pos - self._read_pos
+        if max_frames is not None:
+            frames = min(frames, max_frames)
+        if frames == 0:
+            return []
+        start = self._read_pos % self.capacity
+        first = min(frames, self.capacity - start)
+        fs = self.frame_size
+        views = [self._view[start * fs:(start + first) * fs]]
+        if first < frames:
+            views.append(self._view[:(frames - first) * fs])
+        return views
+
+    def advance(self, frames: int):
+        """ Release frames returned by peek() (consumer side).
+        """
+        self._read_pos += min(frames, self._write_pos - self._read_pos)
+
+    def read(self, max_frames: int | None = None) -> bytes:
+        """ Copy out and release up to max_frames frames (consumer side).
+        """
+        views = self.peek(max_frames)
+        data = b''.join(views)
+        self.advance(len(data) // self.frame_size)
+        return data
+
+    def clear(self):
+        """ Discard all readable frames and reset the overrun counters. Only call while the producer is idle.
+        """
+        self._read_pos = self._write_pos
+        self.overruns = 0
+        self.dropped_frames = 0
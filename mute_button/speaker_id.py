@@ -0,0 +1,275 @@
+import functools
+import os
+
+import numpy as np
+
+from mute_button.encoding import read_audio
+
+
+FRAME_SECONDS = 0.025
+HOP_SECONDS = 0.010
+N_MELS = 26
+N_MFCC = 13
+EMBEDDING_SIZE = 2 * N_MFCC
+SILENCE_DB = -45.0
+WINDOW_SECONDS = 0.3
+# Shorter window classified alongside the full one by the live detector, on its MFCC means only, so that muting starts
+# soon after the onset of a target speaker. Its decisions are less reliable, which the release hold smooths over.
+ONSET_WINDOW_SECONDS = 0.1
+MIN_VOICED_RATIO = 0.3
+SAMPLE_EXTENSIONS = ('.wav', '.flac')
+# RMS distance per dimension in standardized embedding space below which a window is attributed to a speaker
+DEFAULT_THRESHOLD = 1.0
+
+
+def to_mono(samples: np.ndarray, channels: int) -> np.ndarray:
+    """ Convert interleaved int16 samples to mono float32 in [-1, 1).
+    """
+    return samples.reshape(-1, channels).mean(axis=1, dtype=np.float32) / 32768.0
+
+
+def read_mono(path: str) -> tuple[np.ndarray, int]:
+    frames, rate = read_audio(path)
+    return to_mono(frames.ravel(), frames.shape[1]), rate
+
+
+def _mel_filterbank(rate: int, n_fft: int, n_mels: int, f_min: float, f_max: float) -> np.ndarray:
+    def hz_to_mel(f):
+        return 2595.0 * np.log10(1.0 + f / 700.0)
+
+    def mel_to_hz(m):
+        return 700.0 * (10.0 ** (m / 2595.0) - 1.0)
+
+    fft_freqs = np.linspace(0, rate / 2, n_fft // 2 + 1)
+    mel_points = mel_to_hz(np.linspace(hz_to_mel(f_min), hz_to_mel(f_max), n_mels + 2))
+    lower, center, upper = mel_points[:-2, None], mel_points[1:-1, None], mel_points[2:, None]
+    rising = (fft_freqs - lower) / (center - lower)
+    falling = (upper - fft_freqs) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).T.astype(np.float32)
+
+
+def _dct_matrix(n_in: int, n_out: int) -> np.ndarray:
+    # Orthonormal DCT-II without the 0th coefficient, which only carries loudness
+    k = np.arange(1, n_out + 1)
+    m = np.arange(n_in)
+    return (np.cos(np.pi * k[None, :] * (m[:, None] + 0.5) / n_in) * np.sqrt(2.0 / n_in)).astype(np.float32)
+
+
+class MfccExtractor:
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.frame_length = int(round(FRAME_SECONDS * rate))
+        self.hop_length = int(round(HOP_SECONDS * rate))
+        self.n_fft = 1 << (self.frame_length - 1).bit_length()
+        self.window = np.hamming(self.frame_length).astype(np.float32)
+        self.mel_filters = _mel_filterbank(rate, self.n_fft, N_MELS, 20.0, min(8000.0, rate / 2))
+        self.dct = _dct_matrix(N_MELS, N_MFCC)
+
+    def frame(self, signal: np.ndarray) -> np.ndarray:
+        """ Strided view of all complete frames in signal.
+        """
+        if len(signal) < self.frame_length:
+            return np.empty((0, self.frame_length), dtype=np.float32)
+        return np.lib.stride_tricks.sliding_window_view(signal, self.frame_length)[::self.hop_length]
+
+    def features(self, frames: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ MFCCs and log energy in dBFS per frame.
+        """
+        energy_db = 10.0 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+        spectrum = np.abs(np.fft.rfft(frames * self.window, n=self.n_fft)) ** 2
+        mfcc = np.log(spectrum.astype(np.float32) @ self.mel_filters + 1e-10) @ self.dct
+        return mfcc, energy_db
+
+
+@functools.cache
+def get_extractor(rate: int) -> MfccExtractor:
+    return MfccExtractor(rate)
+
+
+def window_frames(rate: int, seconds: float = WINDOW_SECONDS) -> int:
+    return int(round(seconds / (get_extractor(rate).hop_length / rate)))
+
+
+def window_embeddings(mfcc: np.ndarray, voiced: np.ndarray, n_frames: int, hop: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """ Mean and standard deviation of the voiced MFCC frames in every window of n_frames frames.
+
+    Returns the embeddings of the windows ending at frame n_frames - 1, n_frames - 1 + hop, ... and a mask of the
+    windows with enough voiced frames to be meaningful.
+    """
+    if len(mfcc) < n_frames:
+        return np.empty((0, EMBEDDING_SIZE), dtype=np.float32), np.empty(0, dtype=bool)
+    weights = voiced.astype(np.float64)
+    weighted = mfcc * weights[:, None]
+    c0 = np.concatenate([[0.0], np.cumsum(weights)])
+    c1 = np.concatenate([np.zeros((1, N_MFCC)), np.cumsum(weighted, axis=0)])
+    c2 = np.concatenate([np.zeros((1, N_MFCC)), np.cumsum(weighted * mfcc, axis=0)])
+    count = (c0[n_frames:] - c0[:-n_frames])[::hop]
+    sum1 = (c1[n_frames:] - c1[:-n_frames])[::hop]
+    sum2 = (c2[n_frames:] - c2[:-n_frames])[::hop]
+    n = np.maximum(count, 1.0)[:, None]
+    mean = sum1 / n
+    std = np.sqrt(np.maximum(sum2 / n - mean ** 2, 0.0))
+    return np.concatenate([mean, std], axis=1).astype(np.float32), count >= MIN_VOICED_RATIO * n_frames
+
+
+def sample_statistics(signal: np.ndarray, rate: int) -> tuple[int, np.ndarray, np.ndarray]:
+    """ Number, sum and sum of squares of the window embeddings of a recorded sample.
+
+    Sums instead of means let speaker centroids and the global scale be updated sample by sample.
+    """
+    extractor = get_extractor(rate)
+    mfcc, energy_db = extractor.features(extractor.frame(signal))
+    n_frames = window_frames(rate)
+    embeddings, valid = window_embeddings(mfcc, energy_db > SILENCE_DB, n_frames, hop=max(1, n_frames // 2))
+    embeddings = embeddings[valid].astype(np.float64)
+    return len(embeddings), embeddings.sum(axis=0), np.square(embeddings).sum(axis=0)
+
+
+class SpeakerModel:
+    """ Nearest-centroid speaker classifier on window embeddings standardized by the library's global spread.
+    """
+    def __init__(self, labels: list[str], centroids: np.ndarray, scale: np.ndarray):
+        self.labels = labels
+        self.scale = scale.astype(np.float32)
+        self.centroids = (centroids / scale).astype(np.float32)
+        self._centroid_norms = np.sum(np.square(self.centroids), axis=1)
+        self._mean_norms = np.sum(np.square(self.centroids[:, :N_MFCC]), axis=1)
+
+    @classmethod
+    def from_statistics(cls, labels: list[str], counts: np.ndarray, sums: np.ndarray, square_sums: np.ndarray) -> 'SpeakerModel':
+        """ Build the model from per-speaker window counts, embedding sums and sums of squares.
+        """
+        labels = [label for label, count in zip(labels, counts) if count > 0]
+        used = counts > 0
+        counts, sums, square_sums = counts[used], sums[used], square_sums[used]
+        if len(labels) == 0:
+            return cls([], np.empty((0, EMBEDDING_SIZE)), np.ones(EMBEDDING_SIZE))
+        total = counts.sum()
+        mean = sums.sum(axis=0) / total
+        variance = square_sums.sum(axis=0) / total - mean ** 2
+        return cls(labels, sums / counts[:, None], np.sqrt(np.maximum(variance, 0.0)) + 1e-3)
+
+    @classmethod
+    def from_directory(cls, speakers_dir: str) -> 'SpeakerModel':
+        labels, counts, sums, square_sums = [], [], [], []
+        for speaker in sorted(os.listdir(speakers_dir)):
+            speaker_dir = os.path.join(speakers_dir, speaker)
+            if not os.path.isdir(speaker_dir):
+                continue
+            count, total, square_total = 0, np.zeros(EMBEDDING_SIZE), np.zeros(EMBEDDING_SIZE)
+            for name in os.listdir(speaker_dir):
+                if name.lower().endswith(SAMPLE_EXTENSIONS):
+                    n, s, s2 = sample_statistics(*read_mono(os.path.join(speaker_dir, name)))
+                    count, total, square_total = count + n, total + s, square_total + s2
+            labels.append(speaker)
+            counts.append(count)
+            sums.append(total)
+            square_sums.append(square_total)
+        if len(labels) == 0:
+            return cls([], np.empty((0, EMBEDDING_SIZE)), np.ones(EMBEDDING_SIZE))
+        return cls.from_statistics(labels, np.array(counts), np.array(sums), np.array(square_sums))
+
+    def classify(self, embeddings: np.ndarray, means_only: bool = False) -> tuple[np.ndarray, np.ndarray]:
+        """ Index of the nearest speaker and RMS distance per dimension for each embedding.
+
+        With means_only only the MFCC means are compared, for windows shorter than WINDOW_SECONDS whose standard
+        deviations are biased low.
+        """
+        if len(self.labels) == 0:
+            return np.zeros(len(embeddings), dtype=np.intp), np.full(len(embeddings), np.inf, dtype=np.float32)
+        if means_only:
+            scaled = embeddings[:, :N_MFCC] / self.scale[:N_MFCC]
+            centroids, centroid_norms = self.centroids[:, :N_MFCC], self._mean_norms
+        else:
+            scaled = embeddings / self.scale
+            centroids, centroid_norms = self.centroids, self._centroid_norms
+        distances = np.sum(np.square(scaled), axis=1)[:, None] - 2 * scaled @ centroids.T + centroid_norms
+        nearest = np.argmin(distances, axis=1)
+        best = np.take_along_axis(distances, nearest[:, None], axis=1)[:, 0]
+        return nearest, np.sqrt(np.maximum(best, 0.0) / scaled.shape[1])
+
+
+class SpeakerDetector:
+    """ Classifies a sliding window of a live int16 stream after every hop and decides whether to mute.
+
+    Every hop classifies the window of the last WINDOW_SECONDS and the shorter one of the last onset_seconds.
+    Muting starts on the first hop where either is attributed to one of the target speakers and ends after
+    release_seconds without such a hop. The short window bounds the delay after a target starts speaking at about
+    onset_seconds, at the cost of less reliable decisions; onset_seconds=WINDOW_SECONDS turns it off. After each
+    push, changes lists (frame offset, muted) for every decision change, with the offset of the frame at which the
+    deciding hop ended in the pushed buffer.
+    """
+    def __init__(self, model: SpeakerModel, rate: int, channels: int, targets=(), threshold: float = DEFAULT_THRESHOLD,
+                 release_seconds: float = 0.3, onset_seconds: float = ONSET_WINDOW_SECONDS):
+        self.model = model
+        self.rate = rate
+        self.channels = channels
+        self.threshold = threshold
+        self.targets = set(targets)
+        self.muted = False
+        self.changes = []
+        self.label = None
+        self.distance = np.inf
+        self._extractor = get_extractor(rate)
+        self._window_frames = window_frames(rate)
+        self._onset_frames = min(window_frames(rate, onset_seconds), self._window_frames)
+        self._release_hops = int(round(release_seconds * rate / self._extractor.hop_length))
+        self._hold = 0
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._mfcc_history = np.zeros((0, N_MFCC), dtype=np.float32)
+        self._voiced_history = np.zeros(0, dtype=bool)
+
+    def reset(self):
+        self.muted = False
+        self.label = None
+        self._hold = 0
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._mfcc_history = np.zeros((0, N_MFCC), dtype=np.float32)
+        self._voiced_history = np.zeros(0, dtype=bool)
+
+    def push(self, data) -> bool:
+        """ Process a buffer of interleaved int16 frames and return whether audio should be muted.
+        """
+        self.changes = []
+        samples = to_mono(np.frombuffer(data, dtype='<i2'), self.channels)
+        pending_length = len(self._pending)
+        signal = np.concatenate([self._pending, samples])
+        frames = self._extractor.frame(signal)
+        self._pending = signal[len(frames) * self._extractor.hop_length:].copy()
+        if len(frames) == 0:
+            return self.muted
+        mfcc, energy_db = self._extractor.features(frames)
+        mfcc = np.concatenate([self._mfcc_history, mfcc])
+        voiced = np.concatenate([self._voiced_history, energy_db > SILENCE_DB])
+        self._mfcc_history = mfcc[-(self._window_frames - 1):]
+        self._voiced_history = voiced[-(self._window_frames - 1):]
+        embeddings, valid = window_embeddings(mfcc, voiced, self._window_frames)
+        embeddings, valid = embeddings[-len(frames):], valid[-len(frames):]
+        onset_embeddings, onset_valid = window_embeddings(mfcc, voiced, self._onset_frames)
+        onset_embeddings, onset_valid = onset_embeddings[-len(frames):], onset_valid[-len(frames):]
+        if len(onset_embeddings) == 0:
+            return self.muted
+        model = self.model  # May be replaced from another thread
+        nearest, distances = model.classify(embeddings)
+        onset_nearest, onset_distances = model.classify(onset_embeddings, means_only=True)
+        recognized = valid & (distances <= self.threshold)
+        target_indices = [i for i, label in enumerate(model.labels) if label in self.targets]
+        # The full windows end at the same hops as the last onset windows
+        hits = onset_valid & (onset_distances <= self.threshold) & np.isin(onset_nearest, target_indices)
+        hits[len(hits) - len(embeddings):] |= recognized & np.isin(nearest, target_indices)
+        frame_ends = np.arange(len(frames) - len(hits), len(frames)) * self._extractor.hop_length + self._extractor.frame_length - pending_length
+        for hit, end in zip(hits, np.clip(frame_ends, 0, len(samples))):
+            was_muted = self.muted
+            if hit:
+                self.muted = True
+                self._hold = self._release_hops
+            elif self._hold > 0:
+                self._hold -= 1
+            else:
+                self.muted = False
+            if self.muted != was_muted:
+                self.changes.append((int(end), self.muted))
+        if len(embeddings) > 0 and valid[-1]:
+            self.label = model.labels[nearest[-1]] if recognized[-1] else None
+            self.distance = float(distances[-1])
+        return self.muted
@@ -0,0 +1,136 @@
+import json
+import logging as log
+import os
+import threading
+
+import numpy as np
+
+from mute_button.speaker_id import EMBEDDING_SIZE, SAMPLE_EXTENSIONS, SpeakerModel, read_mono, sample_statistics
+
+
+MANIFEST_NAME = 'manifest.json'
+# Columns of the per-sample statistics: window count, embedding sums, embedding sums of squares
+STATS_SIZE = 1 + 2 * EMBEDDING_SIZE
+
+
+class SpeakerIndex:
+    """ On-disk index of the speaker samples in speakers_dir.
+
+    The manifest maps each sample path to its size, mtime and row in the per-sample statistics array, so only new or
+    changed samples are featurized on update. Arrays are written under a new generation number and loaded memory
+    mapped; the manifest is replaced last and acts as the commit point.
+    """
+    def __init__(self, speakers_dir: str, index_dir: str):
+        self.speakers_dir = speakers_dir
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._manifest = None
+        self._sample_stats = None
+        self._model = None
+        self._scanned = False
+
+    def _path(self, name: str, generation: int) -> str:
+        return os.path.join(self.index_dir, '{}-{}.npy'.format(name, generation))
+
+    def _load(self):
+        manifest_path = os.path.join(self.index_dir, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            generation = manifest['generation']
+            self._sample_stats = np.load(self._path('samples', generation), mmap_mode='r')
+            centroids = np.load(self._path('centroids', generation), mmap_mode='r')
+            scale = np.load(self._path('scale', generation), mmap_mode='r')
+            self._manifest = manifest
+            self._model = SpeakerModel(manifest['speakers'], np.array(centroids), np.array(scale))
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(manifest_path):
+                log.warning('Rebuilding speaker index: {}'.format(e))
+            self._manifest = {'generation': 0, 'speakers': [], 'samples': {}}
+            self._sample_stats = np.zeros((0, STATS_SIZE))
+            self._model = None
+
+    def _scan(self) -> dict[str, os.stat_result]:
+        files = {}
+        for speaker in os.scandir(self.speakers_dir):
+            if not speaker.is_dir():
+                continue
+            for sample in os.scandir(speaker.path):
+                if sample.is_file() and sample.name.lower().endswith(SAMPLE_EXTENSIONS):
+                    files[speaker.name + '/' + sample.name] = sample.stat()
+        return files
+
+    def update(self) -> SpeakerModel:
+        """ Featurize new or changed samples, drop removed ones and return the current speaker model.
+        """
+        with self._lock:
+            if self._manifest is None:
+                self._load()
+            indexed = self._manifest['samples']
+            files = self._scan()
+            self._scanned = True
+            unchanged = {path: entry for path, entry in indexed.items()
+                         if path in files and entry['size'] == files[path].st_size and entry['mtime_ns'] == files[path].st_mtime_ns}
+            changed = [path for path in files if path not in unchanged]
+            if len(changed) == 0 and len(unchanged) == len(indexed) and self._model is not None:
+                return self._model
+
+            new_stats = []
+            for path in changed:
+                try:
+                    count, sums, square_sums = sample_statistics(*read_mono(os.path.join(self.speakers_dir, path)))
+                except (OSError, RuntimeError, ValueError) as e:
+                    log.warning('Skipping speaker sample {}: {}'.format(path, e))
+                    continue
+                new_stats.append((path, np.concatenate([[count], sums, square_sums])))
+
+            paths = sorted(unchanged, key=lambda path: unchanged[path]['row']) + [path for path, _ in new_stats]
+            kept_rows = [unchanged[path]['row'] for path in paths[:len(unchanged)]]
+            sample_stats = np.concatenate([np.asarray(self._sample_stats[kept_rows]).reshape(-1, STATS_SIZE)] +
+                                          [stats[None, :] for _, stats in new_stats])
+
+            speakers = sorted({path.split('/', 1)[0] for path in paths})
+            speaker_row = {speaker: row for row, speaker in enumerate(speakers)}
+            speaker_rows = np.array([speaker_row[path.split('/', 1)[0]] for path in paths], dtype=np.intp)
+            speaker_stats = np.zeros((len(speakers), STATS_SIZE))
+            np.add.at(speaker_stats, speaker_rows, sample_stats)
+            model = SpeakerModel.from_statistics(speakers, speaker_stats[:, 0], speaker_stats[:, 1:1 + EMBEDDING_SIZE],
+                                                 speaker_stats[:, 1 + EMBEDDING_SIZE:])
+
+            generation = self._manifest['generation'] + 1
+            os.makedirs(self.index_dir, exist_ok=True)
+            np.save(self._path('samples', generation), sample_stats)
+            np.save(self._path('centroids', generation), model.centroids * model.scale)
+            np.save(self._path('scale', generation), model.scale)
+            manifest = {
+                'generation': generation,
+                'speakers': model.labels,
+                'samples': {path: {'size': files[path].st_size, 'mtime_ns': files[path].st_mtime_ns, 'row': row}
+                            for row, path in enumerate(paths)},
+            }
+            manifest_tmp = os.path.join(self.index_dir, MANIFEST_NAME + '.tmp')
+            with open(manifest_tmp, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(manifest_tmp, os.path.join(self.index_dir, MANIFEST_NAME))
+
+            self._manifest = manifest
+            self._sample_stats = np.load(self._path('samples', generation), mmap_mode='r')
+            self._model = model
+            self._remove_stale_generations(generation)
+            log.info('Speaker index updated: {} new or changed, {} sample(s) of {} speaker(s).'.format(len(new_stats), len(paths), len(model.labels)))
+            return model
+
+    def _remove_stale_generations(self, generation: int):
+        for name in os.listdir(self.index_dir):
+            if name.endswith('.npy') and not name.endswith('-{}.npy'.format(generation)):
+                try:
+                    os.remove(os.path.join(self.index_dir, name))
+                except OSError:
+                    pass  # Still mapped on Windows, removed by a later update
+
+    def get_model(self) -> SpeakerModel:
+        """ The current speaker model. The first call checks the samples against the index once.
+        """
+        with self._lock:
+            model = self._model if self._scanned else None
+        return model if model is not None else self.update()
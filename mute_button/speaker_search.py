@@ -0,0 +1,83 @@
+import bisect
+import threading
+
+
+class SpeakerSearch:
+    """ Case-insensitive prefix and substring search over speaker names with paginated results.
+
+    Names are kept sorted by their lowercase form, so prefix matches are a bisected range. Substring queries of at
+    least NGRAM characters intersect the names containing each of the query's n-grams and check the few candidates,
+    shorter ones scan all names. Prefix matches are listed before other matches, both in alphabetical order.
+    """
+    NGRAM = 3
+
+    def __init__(self, names=()):
+        self.version = 0
+        self._keys: list[tuple[str, str]] = sorted({(name.lower(), name) for name in names})  # (lowercase name, name)
+        self._ngrams: dict[str, set[tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+        for key in self._keys:
+            self._index_ngrams(key)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _find(self, name: str) -> str | None:
+        lower = name.lower()
+        index = bisect.bisect_left(self._keys, (lower,))
+        found = None
+        while index < len(self._keys) and self._keys[index][0] == lower:
+            if self._keys[index][1] == name:
+                return name
+            found = found or self._keys[index][1]
+            index += 1
+        return found
+
+    def _index_ngrams(self, key: tuple[str, str]):
+        for i in range(len(key[0]) - self.NGRAM + 1):
+            self._ngrams.setdefault(key[0][i:i + self.NGRAM], set()).add(key)
+
+    def add(self, name: str) -> str:
+        """ Add a speaker, bumping version if it is new so that sessions know to refresh their results, and return its
+        spelling. A name that differs from an existing one only in case is the existing speaker, as speaker directories
+        are case-insensitive on Windows.
+        """
+        with self._lock:
+            existing = self._find(name)
+            if existing is not None:
+                return existing
+            key = (name.lower(), name)
+            bisect.insort(self._keys, key)
+            self._index_ngrams(key)
+            self.version += 1
+            return name
+
+    def find(self, name: str) -> str | None:
+        """ The spelling of the speaker named name regardless of case, preferring an exact match, or None.
+        """
+        with self._lock:
+            return self._find(name)
+
+    def __contains__(self, name: str) -> bool:
+        return self.find(name) is not None
+
+    def search(self, query: str, offset: int = 0, limit: int = 50) -> tuple[list[str], int]:
+        """ The names matching query from offset on, at most limit of them, and the total number of matches.
+        """
+        query = query.strip().lower()
+        with self._lock:
+            if query == '':
+                return [name for _, name in self._keys[offset:offset + limit]], len(self._keys)
+            start = bisect.bisect_left(self._keys, (query,))
+            end = bisect.bisect_left(self._keys, (query + '\U0010ffff',), lo=start)
+            if len(query) >= self.NGRAM:
+                postings = sorted((self._ngrams.get(query[i:i + self.NGRAM], set()) for i in range(len(query) - self.NGRAM + 1)), key=len)
+                candidates = set.intersection(*postings) if len(postings) > 1 else postings[0]
+            else:
+                candidates = self._keys
+            others = sorted(key for key in candidates if query in key[0] and not key[0].startswith(query))
+            prefix_count = end - start
+            page = self._keys[start + offset:end][:limit] if offset < prefix_count else []
+            others_offset = max(0, offset - prefix_count)
+            page += others[others_offset:others_offset + limit - len(page)]
+            return [name for _, name in page], prefix_count + len(others)
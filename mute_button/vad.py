@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import soundfile as sf
+
+from mute_button.encoding import BLOCK_SECONDS, STORAGE_EXTENSION, open_audio_writer
+from mute_button.speaker_id import SILENCE_DB, to_mono
+
+
+FRAME_SECONDS = 0.02
+# Frames this far above the recording's noise floor are voiced, quieter ones only with a fricative-like zero crossing
+# rate. The margin is applied to the noise floor but the threshold never drops below SILENCE_DB or rises past the
+# margin above it, so takes without pauses are kept as a whole.
+ENERGY_MARGIN_DB = 12.0
+WEAK_ENERGY_MARGIN_DB = 6.0
+FRICATIVE_ZCR = 0.25
+NOISE_FLOOR_PERCENTILE = 10
+PADDING_SECONDS = 0.15
+MAX_PAUSE_SECONDS = 0.4
+MIN_CHUNK_SECONDS = 1.0
+
+
+def frame_features(signal: np.ndarray, frame_length: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Energy in dB and zero crossing rate of consecutive, non-overlapping frames of a mono float32 signal.
+    """
+    n = len(signal) // frame_length
+    frames = signal[:n * frame_length].reshape(n, frame_length)
+    energy_db = 10.0 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / frame_length
+    return energy_db, zcr
+
+
+def frame_activity(energy_db: np.ndarray, zcr: np.ndarray) -> np.ndarray:
+    """ Voice activity of the frames of a recording from their frame_features().
+    """
+    if len(energy_db) == 0:
+        return np.zeros(0, dtype=bool)
+    threshold = np.clip(np.percentile(energy_db, NOISE_FLOOR_PERCENTILE) + ENERGY_MARGIN_DB, SILENCE_DB, SILENCE_DB + ENERGY_MARGIN_DB)
+    weak = (energy_db > threshold - WEAK_ENERGY_MARGIN_DB) & (zcr > FRICATIVE_ZCR)
+    return (energy_db > threshold) | weak
+
+
+def voiced_segments(activity: np.ndarray, frame_length: int, padding: float = PADDING_SECONDS,
+                    max_pause: float = MAX_PAUSE_SECONDS) -> list[tuple[int, int]]:
+    """ Sample ranges [start, end) of voiced audio, padded by padding seconds and with pauses up to max_pause bridged.
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], activity.astype(np.int8), [0]])))
+    starts, ends = edges[::2], edges[1::2]
+    if len(starts) == 0:
+        return []
+    # A segment is continued by the next one when the pause in between is short enough
+    separate = np.concatenate([[True], starts[1:] - ends[:-1] > round(max_pause / FRAME_SECONDS)])
+    starts = starts[separate]
+    ends = ends[np.concatenate([separate[1:], [True]])]
+    pad = int(round(padding / FRAME_SECONDS))
+    starts = np.maximum(starts - pad, 0) * frame_length
+    ends = np.minimum(ends + pad, len(activity)) * frame_length
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def save_voiced(path: str, output_dir: str, chunk_seconds: float | None = None, extension: str = STORAGE_EXTENSION) -> list[str]:
+    """ Write the voiced parts of a recording to output_dir in the format given by extension and return the written paths.
+
+    Leading and trailing silence and long pauses are cut. Without chunk_seconds the voiced parts are joined into one
+    file, otherwise they are split into files of chunk_seconds, dropping a last chunk shorter than MIN_CHUNK_SECONDS.
+    The recording is read in blocks twice, once for the voice activity and once to copy the voiced parts.
+    """
+    with sf.SoundFile(path) as src:
+        rate, channels = src.samplerate, src.channels
+        frame_length = int(round(FRAME_SECONDS * rate))
+        # Blocks hold whole frames, so the features are those of the whole recording while only a block is in memory
+        blocksize = max(1, BLOCK_SECONDS * rate // frame_length) * frame_length
+        features = [frame_features(to_mono(block.ravel(), channels), frame_length)
+                    for block in src.blocks(blocksize=blocksize, dtype='int16', always_2d=True)]
+        activity = frame_activity(np.concatenate([energy_db for energy_db, _ in features] or [np.zeros(0)]),
+                                  np.concatenate([zcr for _, zcr in features] or [np.zeros(0)]))
+        segments = voiced_segments(activity, frame_length)
+        if len(segments) == 0:
+            return []
+        total = sum(end - start for start, end in segments)
+        size = int(chunk_seconds * rate) if chunk_seconds else total
+        chunk_count = -(-total // size)
+        if chunk_count > 1 and total - (chunk_count - 1) * size < MIN_CHUNK_SECONDS * rate:
+            chunk_count -= 1
+            total = chunk_count * size
+        name = os.path.splitext(os.path.basename(path))[0]
+        os.makedirs(output_dir, exist_ok=True)
+        paths = [os.path.join(output_dir, name + ('-{}'.format(i + 1) if chunk_count > 1 else '') + extension) for i in range(chunk_count)]
+        # The voiced ranges are copied block by block, starting the next chunk file every size frames
+        written = 0
+        output = None
+        try:
+            for start, end in segments:
+                src.seek(start)
+                position = start
+                while position < end and written < total:
+                    if written % size == 0:
+                        if output is not None:
+                            output.close()
+                        output = open_audio_writer(paths[written // size], rate, channels)
+                    count = min(end - position, size - written % size, total - written, blocksize)
+                    output.write(src.read(count, dtype='int16', always_2d=True))
+                    position += count
+                    written += count
+        finally:
+            if output is not None:
+                output.close()
+    return paths